@@ -7,6 +7,7 @@ from .configuration import ConfigurationSubCommand
 from .database import DatabaseSubCommand
 from .jwttoken import JWTSubCommand
 from .migrate import MigrateSubCommand
+from .scheduler import SchedulerSubCommand
 from .worker import WorkerSubCommand
 
 
@@ -28,6 +29,7 @@ class EntryPoint(Root):
         DatabaseSubCommand,
         JWTSubCommand,
         MigrateSubCommand,
+        SchedulerSubCommand,
         WorkerSubCommand,
     ]
 
@@ -0,0 +1,81 @@
+import signal
+import threading
+
+from easycli import SubCommand, Argument
+from nanohttp import settings
+
+
+class StartSubSubCommand(SubCommand):
+    __command__ = 'start'
+    __help__ = 'Starts the recurring jobs scheduler.'
+    __arguments__ = [
+        Argument(
+            '-i',
+            '--interval',
+            type=float,
+            default=None,
+            help='Seconds between checking for due jobs.',
+        ),
+        Argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Maximum number of due jobs to enqueue at once',
+        ),
+        Argument(
+            '-t',
+            '--number-of-threads',
+            type=int,
+            default=None,
+            help='Number of the scheduler threads, the due jobs are locked '
+                 'using SKIP LOCKED, so they would not be enqueued twice.',
+        ),
+    ]
+
+    def __call__(self, args):
+        from restfulpy.scheduler import scheduler, iter_recurring_task_types
+
+        stop = threading.Event()
+        signal.signal(signal.SIGINT, lambda *a: stop.set())
+        signal.signal(signal.SIGTERM, lambda *a: stop.set())
+
+        if args.interval is not None:
+            settings.jobs.merge({'interval': args.interval})
+
+        print('The following jobs would be scheduled:')
+        for name, task_type in iter_recurring_task_types():
+            print('  %s: %s' % (name, task_type.__cron__))
+
+        number_of_threads = \
+            args.number_of_threads or settings.jobs.number_of_threads
+
+        threads = [
+            threading.Thread(
+                target=scheduler,
+                name='restfulpy-scheduler-thread-%s' % i,
+                daemon=True,
+                kwargs=dict(stop=stop, batch_size=args.batch_size)
+            )
+            for i in range(number_of_threads)
+        ]
+        for t in threads:
+            t.start()
+
+        print('Scheduler started with %d threads' % number_of_threads)
+        print('Press Ctrl+C to terminate scheduler')
+
+        # Waiting in the main thread to keep receiving the signals
+        while any(t.is_alive() for t in threads):
+            stop.wait(1)
+
+        for t in threads:
+            t.join()
+
+
+class SchedulerSubCommand(SubCommand):
+    __command__ = 'scheduler'
+    __help__ = 'Recurring jobs administration'
+    __arguments__ = [
+        StartSubSubCommand,
+    ]
@@ -1,6 +1,11 @@
+import itertools
+import os
 import signal
 import sys
 import threading
+import time
+import traceback
+from urllib.request import urlopen
 
 from easycli import SubCommand, Argument
 from nanohttp import settings
@@ -31,11 +36,61 @@ class StartSubSubCommand(SubCommand):
             default=None,
             help='Number of working threads',
         ),
+        Argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Maximum number of tasks to claim at once',
+        ),
+        Argument(
+            '-l',
+            '--listen',
+            action='store_true',
+            default=False,
+            help='Wake up on PostgreSQL notifications instead of polling',
+        ),
+        Argument(
+            '--processes',
+            type=int,
+            default=None,
+            help='Number of supervised worker processes, each one runs '
+                 '--number-of-threads threads',
+        ),
+        Argument(
+            '-a',
+            '--async',
+            dest='async_',
+            action='store_true',
+            default=False,
+            help='Runs an event loop per thread, awaiting `async def do_` '
+                 'tasks concurrently',
+        ),
+        Argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Maximum number of concurrent tasks per thread in async mode',
+        ),
+        Argument(
+            '--autoscale',
+            default=None,
+            metavar='MIN:MAX',
+            help='Grows and shrinks the threads, or the processes if '
+                 'forking, between MIN and MAX according to the queue',
+        ),
+        Argument(
+            '-m',
+            '--metrics-port',
+            type=int,
+            default=None,
+            help='Serves the metrics over HTTP on this port, the worker '
+                 'processes use the subsequent ports',
+        ),
     ]
+    terminating = False
 
     def __call__(self, args):
-        from restfulpy.taskqueue import worker
-
         signal.signal(signal.SIGINT, self.kill_signal_handler)
         signal.signal(signal.SIGTERM, self.kill_signal_handler)
 
@@ -45,6 +100,21 @@ class StartSubSubCommand(SubCommand):
         if args.gap is not None:
             settings.worker.merge({'gap': args.gap})
 
+        if args.batch_size is not None:
+            settings.worker.merge({'batch_size': args.batch_size})
+
+        if args.listen:
+            settings.worker.merge({'listen': True})
+
+        if args.metrics_port is not None:
+            settings.worker.merge({'metrics_port': args.metrics_port})
+
+        if args.autoscale:
+            minimum, maximum = (int(i) for i in args.autoscale.split(':'))
+            settings.worker.autoscale.merge(
+                {'minimum': minimum, 'maximum': maximum}
+            )
+
         print(
             f'The following task types would be processed with gap of '
             f'{settings.worker.gap}s:'
@@ -53,21 +123,324 @@ class StartSubSubCommand(SubCommand):
 
         number_of_threads = \
             args.number_of_threads or settings.worker.number_of_threads
+        number_of_processes = args.processes \
+            if args.processes is not None \
+            else settings.worker.number_of_processes
+
+        if number_of_processes:
+            self.supervise(args, number_of_processes, number_of_threads)
+            return
+
+        if settings.worker.metrics_port:
+            self.start_metrics_server(settings.worker.metrics_port)
+
+        if settings.worker.autoscale.maximum:
+            self.autoscale_threads(args)
+            return
+
+        self.start_threads(args, number_of_threads)
+
+        print('Worker started with %d threads' % number_of_threads)
+        print('Press Ctrl+C to terminate worker')
+        signal.pause()
+
+    @staticmethod
+    def start_metrics_server(port):
+        from restfulpy.metrics import MetricsServer
+        from restfulpy.orm import create_thread_unsafe_session
+        from restfulpy.taskqueue import RestfulpyTask, metrics
+
+        def queue_depth():
+            session = create_thread_unsafe_session()
+            try:
+                return RestfulpyTask.get_queue_depth(session)
+            finally:
+                session.close()
+
+        server = MetricsServer(metrics, port, queue_depth=queue_depth)
+        server.start()
+        print('Metrics are served on port: %d' % server.port)
+        return server
+
+    @staticmethod
+    def start_threads(args, number_of_threads, stop=None,
+                      name='restfulpy-worker'):
+        from restfulpy.taskqueue import worker, async_worker
+
+        kwargs = dict(
+            statuses=args.status,
+            filters=args.filter,
+            stop=stop
+        )
+        if args.async_:
+            target = async_worker
+            kwargs['concurrency'] = args.concurrency
+        else:
+            target = worker
+
+        threads = []
         for i in range(number_of_threads):
             t = threading.Thread(
-                    target=worker,
-                    name='restfulpy-worker-thread-%s' % i,
+                    target=target,
+                    name='%s-thread-%s' % (name, i),
                     daemon=True,
-                    kwargs=dict(
-                        statuses=args.status,
-                        filters=args.filter
-                    )
+                    kwargs=kwargs
                 )
             t.start()
+            threads.append(t)
 
-        print('Worker started with %d threads' % number_of_threads)
+        return threads
+
+    @staticmethod
+    def create_autoscaler(args, slots_per_unit):
+        from restfulpy.autoscaler import Autoscaler
+
+        config = settings.worker.autoscale
+        if args.async_:
+            slots_per_unit *= args.concurrency \
+                or settings.worker.concurrency
+        else:
+            slots_per_unit *= settings.worker.batch_size
+
+        return Autoscaler(
+            config.minimum,
+            config.maximum,
+            slots=slots_per_unit,
+            cooldown=config.cooldown,
+            statuses=args.status,
+            filters=args.filter
+        )
+
+    def autoscale_threads(self, args):
+        from restfulpy.autoscaler import CONNECTIONS_PER_THREAD
+        from restfulpy.orm import create_engine
+        from restfulpy.taskqueue import get_worker_prefix
+
+        config = settings.worker.autoscale
+        autoscaler = self.create_autoscaler(args, 1)
+
+        # The connections of the minimum threads are kept in the pool, the
+        # others are closed when returned, so the pool shrinks with threads.
+        args.application.engine.dispose()
+        args.application.initialize_orm(create_engine(
+            pool_size=CONNECTIONS_PER_THREAD * config.minimum,
+            max_overflow=CONNECTIONS_PER_THREAD *
+            (config.maximum - config.minimum)
+        ))
+
+        # (thread, stop event)
+        pool = []
+        counter = 0
+
+        def resize(size):
+            nonlocal counter
+            while len(pool) > size:
+                # Draining the last thread
+                pool.pop()[1].set()
+
+            while len(pool) < size:
+                stop = threading.Event()
+                thread, = self.start_threads(
+                    args,
+                    1,
+                    stop=stop,
+                    name='restfulpy-worker-%d' % counter
+                )
+                counter += 1
+                pool.append((thread, stop))
+
+        resize(config.minimum)
+        print(
+            'Worker started with %d to %d threads' % (
+                config.minimum,
+                config.maximum
+            )
+        )
         print('Press Ctrl+C to terminate worker')
-        signal.pause()
+
+        while True:
+            time.sleep(config.interval)
+            pool[:] = [i for i in pool if i[0].is_alive()]
+            try:
+                ready, busy = autoscaler.sample([get_worker_prefix()])
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            size = autoscaler.decide(len(pool), ready, busy)
+            if size != len(pool):
+                print(
+                    'Resizing the worker from %d to %d threads' % (
+                        len(pool),
+                        size
+                    )
+                )
+                resize(size)
+
+    def supervise(self, args, number_of_processes, number_of_threads):
+        children = {}
+
+        def terminate(signal_number, frame):
+            self.terminating = True
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:  # pragma: no cover
+                    pass
+
+        signal.signal(signal.SIGINT, terminate)
+        signal.signal(signal.SIGTERM, terminate)
+
+        autoscaler = None
+        if settings.worker.autoscale.maximum:
+            autoscaler = self.create_autoscaler(args, number_of_threads)
+            number_of_processes = settings.worker.autoscale.minimum
+
+        # Children must not share the parent's pooled connections
+        args.application.engine.dispose()
+
+        for i in range(number_of_processes):
+            children[self.spawn(args, number_of_threads, i)] = i
+
+        print(
+            'Worker started with %d processes of %d threads' % (
+                number_of_processes,
+                number_of_threads
+            )
+        )
+        print('Press Ctrl+C to terminate worker')
+
+        # The processes being drained, they are not restarted
+        retiring = set()
+        next_sample = time.monotonic()
+        while children:
+            if autoscaler is None:
+                pid, status = os.wait()
+            else:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+
+            if not pid:
+                if time.monotonic() >= next_sample and not self.terminating:
+                    next_sample = \
+                        time.monotonic() + settings.worker.autoscale.interval
+                    self.rescale(
+                        args,
+                        autoscaler,
+                        children,
+                        retiring,
+                        number_of_threads
+                    )
+
+                time.sleep(settings.worker.gap)
+                continue
+
+            index = children.pop(pid, None)
+            if pid in retiring:
+                retiring.discard(pid)
+                continue
+
+            if index is None or self.terminating:
+                continue
+
+            print(
+                'Worker process %d exited with status %d, restarting' % (
+                    pid,
+                    status
+                )
+            )
+            time.sleep(settings.worker.gap)
+            children[self.spawn(args, number_of_threads, index)] = index
+
+    def rescale(self, args, autoscaler, children, retiring,
+                number_of_threads):
+        from restfulpy.taskqueue import get_worker_prefix
+
+        active = {p: i for p, i in children.items() if p not in retiring}
+        try:
+            ready, busy = autoscaler.sample(
+                [get_worker_prefix(p) for p in active]
+            )
+        except Exception:
+            traceback.print_exc()
+            return
+
+        finally:
+            # Children must not share the parent's pooled connections
+            args.application.engine.dispose()
+
+        size = autoscaler.decide(len(active), ready, busy)
+        if size == len(active):
+            return
+
+        print(
+            'Resizing the worker from %d to %d processes' % (
+                len(active),
+                size
+            )
+        )
+
+        # Draining the processes having the greatest indexes
+        excess = sorted(active, key=active.get, reverse=True)
+        for pid in excess[:max(len(active) - size, 0)]:
+            retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+        # The indexes of the retiring processes are still in use
+        free_indexes = (
+            i for i in itertools.count() if i not in children.values()
+        )
+        for _ in range(size - len(active)):
+            index = next(free_indexes)
+            children[self.spawn(args, number_of_threads, index)] = index
+
+    def spawn(self, args, number_of_threads, index):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        # Child process, SIGTERM drains the threads, SIGINT is left to the
+        # supervisor which is in the same process group.
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *a: stop.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        exit_code = 0
+        try:
+            from restfulpy.taskqueue import watchdog
+
+            # The supervisor restarts this process if a task is stuck
+            watchdog.exit_on_stuck = True
+
+            args.application.initialize_orm()
+            if settings.worker.metrics_port:
+                self.start_metrics_server(
+                    settings.worker.metrics_port + index
+                )
+
+            threads = self.start_threads(
+                args,
+                number_of_threads,
+                stop=stop,
+                name='restfulpy-worker-%s' % index
+            )
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(timeout=1)
+
+                    # A crashed thread, draining the others and letting the
+                    # supervisor to restart this process.
+                    if not t.is_alive() and not stop.is_set():
+                        stop.set()
+                        exit_code = 1
+
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
 
     @staticmethod
     def kill_signal_handler(signal_number, frame):
@@ -90,6 +463,77 @@ class CleanupSubSubCommand(SubCommand):
         DBSession.commit()
 
 
+class StatsSubSubCommand(SubCommand):
+    __command__ = 'stats'
+    __help__ = 'Shows the queue depth, or the metrics of a running worker'
+    __arguments__ = [
+        Argument(
+            '-u',
+            '--url',
+            default=None,
+            help='The metrics url of a running worker, i.e: '
+                 'http://localhost:9100',
+        ),
+    ]
+
+    def __call__(self, args):
+        if args.url:
+            with urlopen(args.url) as response:
+                print(response.read().decode(), end='')
+            return
+
+        from restfulpy.orm import DBSession
+        from restfulpy.taskqueue import RestfulpyTask
+
+        depth = RestfulpyTask.get_queue_depth(DBSession)
+        print('%-12s %8s %10s' % ('Status', 'Priority', 'Count'))
+        for (status, priority), count in sorted(depth.items()):
+            print('%-12s %8d %10d' % (status, priority, count))
+
+
+class ArchiveSubSubCommand(SubCommand):
+    __command__ = 'archive'
+    __help__ = 'Moves the finished tasks into the archive table'
+    __arguments__ = [
+        Argument(
+            '-d',
+            '--days',
+            type=int,
+            default=None,
+            help='Archives the tasks created before this number of days ago',
+        ),
+        Argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Maximum number of tasks to move per statement',
+        ),
+    ]
+
+    def __call__(self, args):
+        from restfulpy.archive import archive_tasks
+        from restfulpy.orm import DBSession
+
+        count = archive_tasks(
+            days=args.days,
+            session=DBSession,
+            batch_size=args.batch_size
+        )
+        print('%d task(s) are archived' % count)
+
+
+class UpgradeSchemaSubSubCommand(SubCommand):
+    __command__ = 'upgrade-schema'
+    __help__ = 'Adds the missing task queue columns and indexes to an ' \
+        'existing database'
+
+    def __call__(self, args):
+        from restfulpy.taskqueue import upgrade_schema
+
+        upgrade_schema(args.application.engine)
+
+
 class WorkerSubCommand(SubCommand):
     __command__ = 'worker'
     __help__ = 'Task queue administration'
@@ -104,5 +548,8 @@ class WorkerSubCommand(SubCommand):
         ),
         StartSubSubCommand,
         CleanupSubSubCommand,
+        StatsSubSubCommand,
+        ArchiveSubSubCommand,
+        UpgradeSchemaSubSubCommand,
     ]
 
@@ -0,0 +1,130 @@
+"""Keeps the live task queue small by moving the finished tasks into the
+``restfulpy_task_archive`` table.
+
+Call :func:`register_archive_job` to run the :class:`ArchiveTask` as a
+recurring job, see :mod:`restfulpy.scheduler`.
+"""
+from datetime import datetime, timedelta
+
+from nanohttp import settings
+from sqlalchemy import Table, Column, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql.expression import text
+
+from . import logger
+from .orm import DBSession, metadata
+from .taskqueue import RestfulpyTask
+
+
+archived_task_table = Table(
+    'restfulpy_task_archive',
+    metadata,
+    *[
+        Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False)
+        for c in RestfulpyTask.__table__.columns
+    ],
+    # The columns of the joined subclass tables, i.e: email
+    Column('data', JSONB, nullable=True),
+    Column('archived_at', DateTime, nullable=False),
+    Index('restfulpy_task_archive_created_at_idx', 'created_at'),
+)
+
+
+def _create_archive_statement():
+    table = RestfulpyTask.__table__
+    mappers = RestfulpyTask.__mapper__.polymorphic_map.values()
+    sub_tables = sorted(
+        {m.local_table for m in mappers} - {table},
+        key=lambda t: t.name
+    )
+
+    columns = [c.name for c in table.columns]
+    ctes = [
+        'batch AS (SELECT id FROM restfulpy_task '
+        'WHERE status IN :statuses AND created_at < :before '
+        'ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED)'
+    ]
+    joins = []
+    data = []
+    for i, sub_table in enumerate(sub_tables):
+        pk = list(sub_table.primary_key.columns)[0].name
+        ctes.append(
+            f'sub{i} AS (DELETE FROM {sub_table.name} USING batch '
+            f'WHERE {sub_table.name}.{pk} = batch.id '
+            f'RETURNING {sub_table.name}.{pk} AS id, '
+            f'to_jsonb({sub_table.name}) AS data)'
+        )
+        joins.append(f'LEFT OUTER JOIN sub{i} ON sub{i}.id = moved.id')
+        data.append(f'COALESCE(sub{i}.data, \'{{}}\'::jsonb)')
+
+    ctes.append(
+        'moved AS (DELETE FROM restfulpy_task USING batch '
+        'WHERE restfulpy_task.id = batch.id RETURNING '
+        f'{", ".join("restfulpy_task." + c for c in columns)})'
+    )
+
+    # The tasks having no subclass table would be archived with NULL data
+    data = f'NULLIF({" || ".join(data)}, \'{{}}\'::jsonb)' if data else 'NULL'
+    return text(
+        f'WITH {", ".join(ctes)} '
+        f'INSERT INTO restfulpy_task_archive '
+        f'({", ".join(columns)}, data, archived_at) '
+        f'SELECT {", ".join("moved." + c for c in columns)}, '
+        f'{data}, '
+        f'timezone(\'utc\', now()) '
+        f'FROM moved {" ".join(joins)}'
+    )
+
+
+def archive(before, session=DBSession, batch_size=None,
+            statuses=('success', 'failed')):
+    """Moves a batch of the finished tasks created before the given time
+    into the archive in a single statement, returns the number of them.
+
+    The rows of the joined subclass tables are kept as JSON in the
+    ``data`` column.
+    """
+    batch_size = batch_size or settings.archive.batch_size
+    result = session.execute(
+        _create_archive_statement(),
+        dict(before=before, limit=batch_size, statuses=tuple(statuses))
+    )
+    return result.rowcount
+
+
+def archive_tasks(days=None, session=DBSession, batch_size=None):
+    """Archives all of the tasks finished before `days` ago, committing
+    after each batch to keep the locks short.
+    """
+    days = settings.archive.days if days is None else days
+    batch_size = batch_size or settings.archive.batch_size
+    before = datetime.utcnow() - timedelta(days=days)
+    archived_task_table.create(bind=session.bind, checkfirst=True)
+
+    total = 0
+    while True:
+        count = archive(before, session=session, batch_size=batch_size)
+        session.commit()
+        total += count
+        logger.debug('%d task(s) are archived' % count)
+        if count < batch_size:
+            return total
+
+
+class ArchiveTask(RestfulpyTask):
+    # Disabled unless the register_archive_job is called
+    __cron__ = None
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'restfulpy_archive'
+    }
+
+    def do_(self, context):
+        archive_tasks()
+
+
+def register_archive_job(cron='0 * * * *'):
+    """Schedules the :class:`ArchiveTask` by the given cron expression, it
+    would be enqueued by the next run of the ``scheduler``.
+    """
+    ArchiveTask.__cron__ = cron
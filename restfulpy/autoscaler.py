@@ -0,0 +1,79 @@
+"""Sizes the worker pool according to the queue, see the ``autoscale``
+section of the ``worker`` settings.
+"""
+import math
+
+from .orm import create_thread_unsafe_session
+from .taskqueue import RestfulpyTask
+
+
+# Each worker thread holds a connection to claim the tasks, one for the
+# DBSession of the tasks and one for its heartbeat.
+CONNECTIONS_PER_THREAD = 3
+
+
+class Autoscaler:
+    """Decides the size of a pool of threads or processes by the queue depth
+    and the share of the busy slots, both sampled from the database.
+
+    While there are ready tasks and the slots are busy the pool is grown, at
+    most doubled per sample. After `cooldown` consecutive samples having no
+    ready task and some idle slots, it is shrunk by one.
+    """
+
+    high_utilization = .8
+
+    def __init__(self, minimum, maximum, slots=1, cooldown=3,
+                 statuses={'new'}, filters=None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+        # Number of tasks a thread or a process could hold at once
+        self.slots = slots
+        self.cooldown = cooldown
+        self.statuses = statuses
+        self.filters = filters
+        self.idle_samples = 0
+
+    def sample(self, worker_prefixes):
+        """Returns the number of the ready tasks and the tasks held by the
+        pool.
+        """
+        session = create_thread_unsafe_session()
+        try:
+            ready = RestfulpyTask.count_ready(
+                self.statuses,
+                self.filters,
+                limit=self.maximum * self.slots,
+                session=session
+            )
+            busy = RestfulpyTask.count_in_progress(
+                worker_prefixes,
+                session=session
+            )
+            return ready, busy
+
+        finally:
+            session.close()
+
+    def decide(self, size, ready, busy):
+        """Returns the new size of the pool."""
+        if size < self.minimum:
+            return self.minimum
+
+        capacity = size * self.slots
+        if ready and busy >= capacity * self.high_utilization:
+            self.idle_samples = 0
+            wanted = math.ceil(ready / self.slots)
+            return min(self.maximum, size + max(1, min(size, wanted)))
+
+        if ready or busy >= capacity:
+            self.idle_samples = 0
+            return min(size, self.maximum)
+
+        self.idle_samples += 1
+        if self.idle_samples < self.cooldown:
+            return size
+
+        self.idle_samples = 0
+        return max(self.minimum, size - 1)
@@ -68,10 +68,54 @@ authentication:
 worker:
   gap: .5
   number_of_threads: 1
-
+  # Forks a supervised pool of processes, each one running
+  # `number_of_threads` threads, zero means no forking.
+  number_of_processes: 0
+  # Maximum number of concurrent tasks per thread in `async` mode
+  concurrency: 100
+  # Seconds, claimed tasks are leased to their worker and renewed by a
+  # heartbeat, in-progress tasks with an expired lease would be popped
+  # again. Zero disables leasing.
+  lease: 300
+  # Seconds, the threads executing an overdue task are interrupted, if
+  # they are still stuck after this, the forked worker process is killed
+  # to be restarted, see: RestfulpyTask.__timeout__
+  timeout_grace: 30
+  # Grows and shrinks the threads, or the processes when forking, between
+  # the minimum and the maximum according to the queue depth sampled every
+  # `interval` seconds, zero maximum disables.
+  autoscale:
+    minimum: 1
+    maximum: 0
+    interval: 5
+    # Consecutive idle samples before shrinking by one
+    cooldown: 3
+  # Serves the metrics in Prometheus text format, zero disables
+  metrics_port: 0
+  # Maximum number of tasks to claim per round-trip
+  batch_size: 1
+  # Wait for PostgreSQL notifications instead of polling every `gap`
+  # seconds, the gap will be used as a fallback timeout. The tasks added
+  # by the ORM are announced only when this is enabled.
+  listen: false
+  channel: restfulpy_task
+  # The ids of the finished tasks are announced here, see:
+  # restfulpy.taskqueue.wait
+  result_channel: restfulpy_task_result
+
+# Moving the finished tasks out of the live queue, see: restfulpy.archive
+archive:
+  # Finished tasks created before this would be archived
+  days: 30
+  # Maximum number of tasks to move per statement
+  batch_size: 1000
+
+# Recurring tasks, see: restfulpy.scheduler
 jobs:
   interval: .5 # Seconds
   number_of_threads: 1
+  # Maximum number of due jobs to enqueue per round-trip
+  batch_size: 100
 
 smtp:
   host: smtp.example.com
@@ -82,6 +126,8 @@ smtp:
   tls: true
   auth: true
   ssl: false
+  # Seconds, for the blocking operations of the connection
+  timeout: 60
 
 """
 
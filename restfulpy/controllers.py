@@ -1,4 +1,5 @@
-from nanohttp import Controller, context, json, RestController, action
+from nanohttp import Controller, context, json, RestController, action, \
+    HTTPAccepted
 
 from restfulpy.helpers import split_url
 from restfulpy.orm import DBSession
@@ -69,3 +70,23 @@ class JSONPatchControllerMixin:
             raise
         finally:
             del context.jsonpatch
+
+
+def wait_for_task(task_id, timeout, location):
+    """Returns the task if it is finished within the `timeout` (in seconds),
+    otherwise responds with ``202 Accepted`` having the `location` of the
+    task's status, i.e: ``/apiv1/tasks/{id}``.
+
+    The task should be committed beforehand.
+    """
+    from restfulpy.taskqueue import wait
+
+    task = wait(task_id, timeout)
+    if task is None:
+        context.response_headers.add_header(
+            'Location',
+            location.format(id=task_id)
+        )
+        raise HTTPAccepted()
+
+    return task
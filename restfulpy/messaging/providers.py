@@ -57,7 +57,8 @@ class SMTPProvider(Messenger):
         smtp_server = (smtplib.SMTP_SSL if smtp_config.ssl else smtplib.SMTP)(
             host=smtp_config.host,
             port=smtp_config.port,
-            local_hostname=smtp_config.local_hostname
+            local_hostname=smtp_config.local_hostname,
+            timeout=smtp_config.timeout
         )
         if smtp_config.tls:  # pragma: no cover
             smtp_server.starttls()
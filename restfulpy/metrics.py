@@ -0,0 +1,173 @@
+"""In-process worker metrics, rendered in the Prometheus text format."""
+import bisect
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300,
+    float('inf')
+)
+
+
+class Histogram:
+    """Fixed buckets histogram, the memory usage does not depend on the
+    number of observations.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class WorkerMetrics:
+    """Per task type counters and histograms, plus the utilization of the
+    worker threads of this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.counters = {}
+        self.run_time = {}
+        self.queue_wait = {}
+        self.threads = 0
+        self.busy_threads = 0
+        self.busy_seconds = 0
+
+    def worker_started(self):
+        with self.lock:
+            self.threads += 1
+
+    def worker_stopped(self):
+        with self.lock:
+            self.threads -= 1
+
+    def task_started(self, task):
+        """Records the queue wait of the task and returns a token to pass to
+        the :meth:`task_finished`.
+        """
+        # Since the task became due: its retry, its schedule or enqueue.
+        waited_since = task.next_attempt_at or task.run_at or task.created_at
+        wait = (datetime.utcnow() - waited_since).total_seconds()
+        with self.lock:
+            self.busy_threads += 1
+            self.queue_wait.setdefault(task.type, Histogram()) \
+                .observe(max(wait, 0))
+
+        return task.type, time.perf_counter()
+
+    def task_finished(self, token, status):
+        type_, started = token
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.busy_threads -= 1
+            self.busy_seconds += elapsed
+            key = (type_, status)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            self.run_time.setdefault(type_, Histogram()).observe(elapsed)
+
+    def get_utilization(self):
+        capacity = self.threads * (time.monotonic() - self.started_at)
+        return self.busy_seconds / capacity if capacity else 0
+
+    def render(self, queue_depth=None):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE restfulpy_tasks_total counter')
+            for (type_, status), count in sorted(self.counters.items()):
+                lines.append(
+                    f'restfulpy_tasks_total'
+                    f'{{type="{type_}",status="{status}"}} {count}'
+                )
+
+            for name, histograms in (
+                    ('restfulpy_task_run_seconds', self.run_time),
+                    ('restfulpy_task_queue_wait_seconds', self.queue_wait)):
+                lines.append(f'# TYPE {name} histogram')
+                for type_, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.render(name, f'type="{type_}"'))
+
+            lines.append('# TYPE restfulpy_worker_threads gauge')
+            lines.append(f'restfulpy_worker_threads {self.threads}')
+            lines.append('# TYPE restfulpy_worker_busy_threads gauge')
+            lines.append(f'restfulpy_worker_busy_threads {self.busy_threads}')
+            lines.append('# TYPE restfulpy_worker_busy_seconds_total counter')
+            lines.append(
+                f'restfulpy_worker_busy_seconds_total {self.busy_seconds}'
+            )
+            lines.append('# TYPE restfulpy_worker_utilization gauge')
+            lines.append(
+                f'restfulpy_worker_utilization {self.get_utilization()}'
+            )
+
+        if queue_depth is not None:
+            lines.append('# TYPE restfulpy_queue_depth gauge')
+            for (status, priority), count in sorted(queue_depth.items()):
+                lines.append(
+                    f'restfulpy_queue_depth'
+                    f'{{status="{status}",priority="{priority}"}} {count}'
+                )
+
+        return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    """Serves the rendered metrics over HTTP in a daemon thread.
+
+    The `queue_depth` callable, if given, is called on each request.
+    """
+
+    def __init__(self, metrics, port, host='', queue_depth=None):
+        super().__init__(name='restfulpy-metrics', daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render(
+                    queue_depth() if queue_depth else None
+                ).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -35,8 +35,12 @@ metadata = MetaData()
 DeclarativeBase = declarative_base(cls=BaseModel, metadata=metadata)
 
 
-def create_engine(url=None, echo=None):
-    return sa_create_engine(url or settings.db.url, echo=echo or settings.db.echo)
+def create_engine(url=None, echo=None, **kwargs):
+    return sa_create_engine(
+        url or settings.db.url,
+        echo=echo or settings.db.echo,
+        **kwargs
+    )
 
 
 def init_model(engine):
@@ -62,8 +66,8 @@ def setup_schema(session=None):
         command.stamp(alembic_cfg, "head")
 
 
-def create_thread_unsafe_session():
-    return session_factory()
+def create_thread_unsafe_session(**kwargs):
+    return session_factory(**kwargs)
 
 
 def commit(func):
@@ -1,12 +1,20 @@
+import base64
+import binascii
 import re
-from datetime import datetime
+import time as time_
+from datetime import datetime, date, time
 
-from nanohttp import context, HTTPBadRequest, settings
-from sqlalchemy import DateTime, between, desc
+import ujson
+from nanohttp import context, HTTPBadRequest
+from sqlalchemy import DateTime, between, desc, and_, or_, false, func, \
+    tuple_, Column
 from sqlalchemy.events import event
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.inspection import inspect
 from sqlalchemy.sql.expression import nullslast, nullsfirst
 
+from ..datetimehelpers import format_datetime, format_date, format_time, \
+    parse_datetime, parse_date, parse_time
 from .field import Field
 
 
@@ -14,6 +22,13 @@ FILTERING_IN_OPERATOR_REGEX = re.compile(r'!?IN\((?P<items>.*)\)')
 FILTERING_BETWEEN_OPERATOR_REGEX = \
     re.compile(r'!?BETWEEN\((?P<min>.*),(?P<max>.*)\)')
 
+COUNT_STRATEGIES = ('exact', 'window', 'estimated', 'cached', 'none')
+MAX_CACHED_COUNTS = 1000
+
+
+# (model, statement, parameters): (count, expiration time)
+_cached_counts = {}
+
 
 class TimestampMixin:
     created_at = Field(
@@ -176,23 +191,49 @@ class DeactivationMixin(ActivationMixin):
 
 
 class PaginationMixin:
+    """Paginates by the ``take`` and ``skip`` parameters.
+
+    In the keyset mode, enabled by the ``__keyset_pagination__``, the next
+    page starts after the row given by the opaque cursor of the ``after``
+    parameter, instead of skipping the previous rows. The cursor of the
+    next page is emitted as the ``X-Pagination-Cursor`` header by the last
+    object of a full page, so the objects should be iterated by the
+    :meth:`iter_paginated`. The rows are ordered by the sort criteria of
+    the :class:`OrderingMixin`, followed by the primary key.
+
+    The ``X-Pagination-Count`` is computed by the ``__count_strategy__``,
+    which is emitted as the ``X-Pagination-Count-Strategy`` header:
+
+    - ``exact``: A separate ``count(*)`` query.
+    - ``window``: A ``count(*) OVER()`` selected along with the page by the
+      :meth:`iter_paginated`, which the objects should be iterated by.
+    - ``estimated``: The number of rows estimated by the planner.
+    - ``cached``: An exact count, cached for ``__count_cache_ttl__``
+      seconds per filtered query in the current process.
+    - ``none``: The count is not emitted at all.
+    """
+
     __take_header_key__ = 'HTTP_X_TAKE'
     __skip_header_key__ = 'HTTP_X_SKIP'
+    __after_header_key__ = 'HTTP_X_AFTER'
     __max_take__ = 100
+    __keyset_pagination__ = False
+    __count_strategy__ = 'exact'
+    __count_cache_ttl__ = 10
 
     @classmethod
     def paginate_by_request(cls, query):
 
         try:
             take = int(
-                context.query.get('take') \
-                or context.environ.get(cls.__take_header_key__) \
+                context.query.get('take')
+                or context.environ.get(cls.__take_header_key__)
                 or cls.__max_take__
             )
 
             skip = int(
-                context.query.get('skip') \
-                or context.environ.get(cls.__skip_header_key__) \
+                context.query.get('skip')
+                or context.environ.get(cls.__skip_header_key__)
                 or 0
             )
         except ValueError:
@@ -201,24 +242,239 @@ class PaginationMixin:
         if take > cls.__max_take__:
             raise HTTPBadRequest()
 
+        after = None
+        if cls.__keyset_pagination__:
+            after = context.query.get('after') \
+                or context.environ.get(cls.__after_header_key__)
+
+        strategy = cls.__count_strategy__
+        if strategy not in COUNT_STRATEGIES:
+            raise ValueError(f'Invalid count strategy: {strategy}')
+
+        # The window counts the rows after the cursor, not all of them
+        if strategy == 'window' and after:
+            strategy = 'exact'
+
         context.response_headers.add_header('X-Pagination-Take', str(take))
         context.response_headers.add_header('X-Pagination-Skip', str(skip))
         context.response_headers.add_header(
-            'X-Pagination-Count',
-            str(query.count())
+            'X-Pagination-Count-Strategy',
+            strategy
+        )
+        if strategy not in ('window', 'none'):
+            context.response_headers.add_header(
+                'X-Pagination-Count',
+                str(cls.count_by_strategy(query, strategy))
+            )
+
+        if not cls.__keyset_pagination__:
+            return query.offset(skip).limit(take)
+
+        if after:
+            query = query.filter(cls._create_keyset_criteria(
+                cls.get_keyset_columns(),
+                cls.decode_cursor(after)
+            ))
+
+        return query.order_by(*inspect(cls).primary_key) \
+            .offset(skip) \
+            .limit(take)
+
+    @classmethod
+    def iter_paginated(cls, query):
+        """Yields the objects of the query returned by the
+        :meth:`paginate_by_request`, emits the count of the ``window``
+        strategy by the first object and the cursor of the next page by the
+        last object of a full page.
+
+        When streaming, the headers should be emitted by the first chunk, so
+        the chunks should not be smaller than the pages.
+        """
+        headers = context.response_headers
+        window = headers.get('X-Pagination-Count-Strategy') == 'window'
+        if not (window or cls.__keyset_pagination__):
+            yield from query
+            return
+
+        # The count is selected along with the objects, but never yielded
+        rows = query.add_columns(func.count().over()) if window \
+            else ((o, None) for o in query)
+
+        take = int(headers['X-Pagination-Take'])
+        count = None
+        for i, (o, row_count) in enumerate(rows, start=1):
+            if window and count is None:
+                count = row_count
+                headers.add_header('X-Pagination-Count', str(count))
+
+            if cls.__keyset_pagination__ and i == take:
+                headers.add_header(
+                    'X-Pagination-Cursor',
+                    cls.encode_cursor(cls.get_keyset_values(o))
+                )
+
+            yield o
+
+        # Beyond the last page
+        if window and count is None:
+            headers.add_header(
+                'X-Pagination-Count',
+                str(query.limit(None).offset(None).count())
+            )
+
+    @classmethod
+    def count_by_strategy(cls, query, strategy='exact'):
+        if strategy == 'exact':
+            return query.count()
+
+        connection = query.session.connection()
+        statement = query.order_by(None).statement.compile(
+            dialect=connection.dialect
         )
-        return query.offset(skip).limit(take)
+
+        if strategy == 'estimated':
+            plan = connection.execute(
+                f'EXPLAIN (FORMAT JSON) {statement}',
+                statement.params
+            ).scalar()
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        key = (cls, str(statement), repr(sorted(statement.params.items())))
+        now = time_.monotonic()
+        count, expires_at = _cached_counts.get(key, (None, 0))
+        if expires_at > now:
+            return count
+
+        if len(_cached_counts) >= MAX_CACHED_COUNTS:
+            for k, (_, e) in list(_cached_counts.items()):
+                if e <= now:
+                    _cached_counts.pop(k, None)
+
+            if len(_cached_counts) >= MAX_CACHED_COUNTS:
+                _cached_counts.clear()
+
+        count = query.count()
+        _cached_counts[key] = count, now + cls.__count_cache_ttl__
+        return count
+
+    @classmethod
+    def get_keyset_columns(cls):
+        """Returns the ``(column, descending)`` of the sort criteria of the
+        request followed by the primary key.
+        """
+        criteria = []
+        if issubclass(cls, OrderingMixin):
+            criteria = cls.get_sort_criteria_by_request()
+
+        return criteria + [(c, False) for c in inspect(cls).primary_key]
+
+    @classmethod
+    def get_keyset_values(cls, o):
+        """Returns the values of the keyset columns of the given object."""
+        mapper = inspect(cls)
+        return [
+            getattr(o, mapper.get_property_by_column(c).key)
+            if isinstance(c, Column) else getattr(o, c.key)
+            for c, _ in cls.get_keyset_columns()
+        ]
+
+    @classmethod
+    def encode_cursor(cls, values):
+        values = [
+            format_datetime(v) if isinstance(v, datetime)
+            else format_date(v) if isinstance(v, date)
+            else format_time(v) if isinstance(v, time)
+            else v if v is None or isinstance(v, (int, float, str, bool))
+            else str(v)
+            for v in values
+        ]
+
+        # The sort expression, to reject the cursors of the other orders
+        payload = ujson.dumps([context.query.get('sort', ''), values])
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        keys = cls.get_keyset_columns()
+        try:
+            sort, values = ujson.loads(
+                base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            )
+            if sort != context.query.get('sort', '') \
+                    or len(values) != len(keys):
+                raise ValueError()
+
+            parsers = {
+                datetime: parse_datetime,
+                date: parse_date,
+                time: parse_time
+            }
+            result = []
+            for (column, _), value in zip(keys, values):
+                try:
+                    type_ = column.type.python_type
+                except (AttributeError, NotImplementedError):
+                    type_ = None
+
+                parse = parsers.get(type_)
+                result.append(
+                    parse(value) if parse and value is not None else value
+                )
+
+        except (ValueError, TypeError, binascii.Error):
+            raise HTTPBadRequest(f'Invalid cursor: {cursor}')
+
+        return result
+
+    @staticmethod
+    def _create_keyset_criteria(keys, values):
+        # The rows after the given values, in the order of the
+        # OrderingMixin, which puts the nulls last when ascending and first
+        # when descending.
+        nullable = [getattr(c, 'nullable', True) for c, _ in keys]
+        directions = {descending for _, descending in keys}
+
+        # A row comparison, which could be matched by a composite index
+        if len(directions) == 1 and not any(nullable):
+            columns = tuple_(*[c for c, _ in keys])
+            return columns < tuple_(*values) if directions.pop() \
+                else columns > tuple_(*values)
+
+        clauses = []
+        equals = []
+        for (column, descending), value, nullable_ in \
+                zip(keys, values, nullable):
+            if value is None:
+                after = column.isnot(None) if descending else None
+
+            elif descending:
+                after = column < value
+
+            elif nullable_:
+                after = or_(column > value, column.is_(None))
+
+            else:
+                after = column > value
+
+            if after is not None:
+                clauses.append(and_(*equals, after))
+
+            equals.append(
+                column.is_(None) if value is None else column == value
+            )
+
+        return or_(*clauses) if clauses else false()
 
 
 class FilteringMixin:
     @classmethod
     def filter_by_request(cls, query):
 
-        for c in cls.iter_json_columns():
-            json_name = cls.get_column_info(c)['json']
-            if json_name in context.query:
-                value = context.query[json_name]
-                query = cls._filter_by_column_value(query, c, value)
+        index = cls.get_json_index()
+        for json_name, value in context.query.items():
+            for c in index.get(json_name, ()):
+                if not c.protected:
+                    query = cls._filter_by_column_value(query, c.column, value)
 
         return query
 
@@ -301,10 +557,10 @@ class OrderingMixin:
         )
 
     @classmethod
-    def sort_by_request(cls, query):
+    def get_sort_criteria_by_request(cls):
         sort_exp = context.query.get('sort', '').strip()
         if not sort_exp:
-            return query
+            return []
 
         sort_columns = [
             (
@@ -314,9 +570,11 @@ class OrderingMixin:
             for c in sort_exp.split(',')
         ]
 
-        criteria = cls.create_sort_criteria(sort_columns)
+        return cls.create_sort_criteria(sort_columns)
 
-        for criterion in criteria:
+    @classmethod
+    def sort_by_request(cls, query):
+        for criterion in cls.get_sort_criteria_by_request():
             query = cls._sort_by_key_value(query, *criterion)
 
         return query
@@ -364,4 +622,3 @@ class FullTextSearchMixin:
         return query.filter(
             cls.__ts_vector__.match(expressions)
         )
-
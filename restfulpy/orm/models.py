@@ -1,15 +1,20 @@
 import functools
+import itertools
 import uuid
+import weakref
+from collections import namedtuple
 from datetime import datetime, date, time
 from decimal import Decimal
 
+import ujson
 from nanohttp import context, HTTPNotFound, HTTPBadRequest, validate
 from sqlalchemy import Column
+from sqlalchemy.event import listen
 from sqlalchemy.ext.associationproxy import ASSOCIATION_PROXY
 from sqlalchemy.ext.hybrid import HYBRID_PROPERTY
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import Query, CompositeProperty, \
-    RelationshipProperty
+    RelationshipProperty, ColumnProperty, SynonymProperty, mapper, load_only
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 from ..datetimehelpers import parse_datetime, parse_date, parse_time, \
@@ -19,7 +24,103 @@ from .metadata import MetadataField
 from .mixins import PaginationMixin, FilteringMixin, OrderingMixin
 
 
+def export_value(v):
+    """Converts a value to its JSON friendly form, regardless of its
+    column.
+    """
+    if v is None:
+        return v
+
+    if isinstance(v, datetime):
+        return format_datetime(v)
+
+    if isinstance(v, date):
+        return format_date(v)
+
+    if isinstance(v, time):
+        return format_time(v)
+
+    if hasattr(v, 'to_dict'):
+        return v.to_dict()
+
+    if isinstance(v, Decimal):
+        return str(v)
+
+    if isinstance(v, uuid.UUID):
+        return v.hex
+
+    return v
+
+
+# The exact python types could be exported without the isinstance chain
+EXPORTERS = {
+    datetime: format_datetime,
+    date: format_date,
+    time: format_time,
+    Decimal: str,
+    uuid.UUID: lambda v: v.hex,
+    str: None,
+    int: None,
+    float: None,
+    bool: None,
+    dict: None,
+    list: None,
+}
+
+
+def create_exporter(column):
+    """Returns a function specialized for the column to export its values.
+
+    Values of the exact python type of the column are converted directly,
+    others fall back to the :func:`export_value`.
+    """
+    property_ = getattr(column, 'property', None)
+    if isinstance(property_, RelationshipProperty) and property_.uselist:
+        return lambda v: [c.to_dict() for c in v]
+
+    if isinstance(property_, CompositeProperty):
+        return lambda v: v.__composite_values__()
+
+    try:
+        type_ = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        return export_value
+
+    if type_ not in EXPORTERS:
+        return export_value
+
+    formatter = EXPORTERS[type_]
+    if formatter is None:
+        return lambda v: v if v.__class__ is type_ else export_value(v)
+
+    return lambda v: formatter(v) if v.__class__ is type_ \
+        else export_value(v)
+
+
+PARSERS = {
+    datetime: parse_datetime,
+    date: parse_date,
+    time: parse_time,
+}
+
+
+JsonColumn = namedtuple(
+    'JsonColumn',
+    'column, type_, parse, readonly, protected, relationship'
+)
+
+
+# Model class: export plan and JSON index, cleared whenever the mappers are
+# configured because a backref could add an attribute to an already mapped
+# class.
+_export_plans = weakref.WeakKeyDictionary()
+_json_indexes = weakref.WeakKeyDictionary()
+listen(mapper, 'after_configured', _export_plans.clear)
+listen(mapper, 'after_configured', _json_indexes.clear)
+
+
 class BaseModel(object):
+    __stream_chunk_size__ = 100
 
     @classmethod
     def get_column(cls, column):
@@ -57,42 +158,67 @@ class BaseModel(object):
     @classmethod
     def prepare_for_export(cls, column, v):
         info = cls.get_column_info(column)
-        param_name = info.get('json')
+        return info.get('json'), create_exporter(column)(v)
 
-        if hasattr(column, 'property') \
-                and isinstance(column.property, RelationshipProperty) \
-                and column.property.uselist:
-            result = [c.to_dict() for c in v]
-
-        elif hasattr(column, 'property') \
-            and isinstance(column.property, CompositeProperty):
-            result = v.__composite_values__()
-
-        elif v is None:
-            result = v
-
-        elif isinstance(v, datetime):
-            result = format_datetime(v)
-
-        elif isinstance(v, date):
-            result = format_date(v)
-
-        elif isinstance(v, time):
-            result = format_time(v)
-
-        elif hasattr(v, 'to_dict'):
-            result = v.to_dict()
+    @classmethod
+    def get_export_plan(cls):
+        """Returns the ``(attribute, json name, exporter)`` of the columns
+        exported by the :meth:`to_dict`, built once per model class.
+        """
+        plan = _export_plans.get(cls)
+        if plan is not None:
+            return plan
+
+        # Respecting the customized export of the subclasses
+        if cls.prepare_for_export.__func__ is not \
+                BaseModel.prepare_for_export.__func__:
+            def create(column):
+                return lambda v: cls.prepare_for_export(column, v)[1]
+        else:
+            create = create_exporter
 
-        elif isinstance(v, Decimal):
-            result = str(v)
+        plan = []
+        names = set()
+        for c in cls.iter_json_columns():
+            name = cls.get_column_info(c).get('json')
+            if name in names:
+                continue
 
-        elif isinstance(v, uuid.UUID):
-            result = v.hex
+            names.add(name)
+            plan.append((c.key, name, create(c)))
 
-        else:
-            result = v
+        plan = _export_plans[cls] = tuple(plan)
+        return plan
 
-        return param_name, result
+    @classmethod
+    def get_json_index(cls):
+        """Maps the JSON names to the tuples of the :class:`JsonColumn` of
+        the columns having them, in the order of declaration, built once per
+        model class.
+        """
+        index = _json_indexes.get(cls)
+        if index is not None:
+            return index
+
+        index = {}
+        for c in cls.iter_json_columns(include_protected_columns=True):
+            info = cls.get_column_info(c)
+            try:
+                type_ = c.type.python_type
+            except (AttributeError, NotImplementedError):
+                type_ = None
+
+            index.setdefault(info['json'], []).append(JsonColumn(
+                c,
+                type_,
+                PARSERS.get(type_),
+                bool(info.get('readonly')),
+                bool(info.get('protected')),
+                hasattr(c, 'property') and hasattr(c.property, 'mapper')
+            ))
+
+        index = _json_indexes[cls] = {k: tuple(v) for k, v in index.items()}
+        return index
 
     @classmethod
     def iter_metadata_fields(cls):
@@ -155,64 +281,119 @@ class BaseModel(object):
 
     @classmethod
     def extract_data_from_request(cls):
-        for c in cls.iter_json_columns(
-                include_protected_columns=True,
-                include_readonly_columns=False
-        ):
-            info = cls.get_column_info(c)
-            param_name = info.get('json')
-
-            if param_name in context.form:
+        index = cls.get_json_index()
+        for param_name, value in context.form.items():
+            for c in index.get(param_name, ()):
+                if c.readonly:
+                    continue
 
-                if hasattr(c, 'property') and hasattr(c.property, 'mapper'):
+                if c.relationship:
                     raise HTTPBadRequest('Invalid attribute')
 
-                value = context.form[param_name]
+                # Parsing date and or time if required, the other values are
+                # passed as is.
+                if c.parse is None:
+                    yield c.column, value
+                    continue
 
-                # Ensuring the python type, and ignoring silently if the
-                # python type is not specified
                 try:
-                    type_ = c.type.python_type
-                except NotImplementedError:
-                    yield c, value
-                    continue
+                    yield c.column, c.parse(value)
+                except ValueError:
+                    raise HTTPBadRequest(f'Invalid date or time: {value}')
 
-                # Parsing date and or time if required.
-                if type_ in (datetime, date, time):
-                    try:
-                        if type_ == time:
-                            yield c, parse_time(value)
+    def to_dict(self, fields=None):
+        if fields is None:
+            return {
+                name: export(getattr(self, key))
+                for key, name, export in self.get_export_plan()
+            }
 
-                        elif type_ == datetime:
-                            yield c, parse_datetime(value)
+        return {
+            name: export(getattr(self, key))
+            for key, name, export in self.get_export_plan()
+            if name in fields
+        }
 
-                        elif type_ == date:
-                            yield c, parse_date(value)
+    @staticmethod
+    def export_fields(o, fields=None):
+        """Exports only the given JSON names of the object, by filtering the
+        result when the ``to_dict`` is overridden without the ``fields``.
+        """
+        if fields is None:
+            return o.to_dict()
 
-                    except ValueError:
-                        raise HTTPBadRequest(f'Invalid date or time: {value}')
+        if type(o).to_dict is BaseModel.to_dict:
+            return o.to_dict(fields)
 
-                else:
-                    yield c, value
+        return {k: v for k, v in o.to_dict().items() if k in fields}
 
-    def to_dict(self):
-        result = {}
-        for c in self.iter_json_columns():
-            result.setdefault(
-                *self.prepare_for_export(c, getattr(self, c.key))
+    @classmethod
+    def get_fields_by_request(cls):
+        """Returns the set of the JSON names requested by the ``fields``
+        query string, or None to export all of them.
+        """
+        value = context.query.get('fields', '').strip()
+        if not value:
+            return None
+
+        fields = {f.strip() for f in value.split(',') if f.strip()}
+
+        # The names exported by an overridden ``to_dict`` are not known
+        if cls.to_dict is not BaseModel.to_dict:
+            return fields
+
+        invalid = fields - {name for _, name, _ in cls.get_export_plan()}
+        if invalid:
+            raise HTTPBadRequest(
+                f'Invalid field(s): {", ".join(sorted(invalid))}'
             )
-        return result
+
+        return fields
+
+    @classmethod
+    def create_load_only_option(cls, fields):
+        """Returns a ``load_only`` option to load just the columns needed to
+        export the given JSON names, or None if some of them are not backed
+        by the mapped columns, i.e: hybrid properties.
+        """
+        mapper_ = inspect(cls)
+        index = cls.get_json_index()
+        keys = set()
+        for name in fields:
+            for c in index[name]:
+                property_ = mapper_.attrs.get(c.column.key)
+                if isinstance(property_, SynonymProperty):
+                    property_ = mapper_.attrs.get(property_.name)
+
+                if isinstance(property_, ColumnProperty):
+                    keys.add(property_.key)
+
+                elif isinstance(property_, CompositeProperty):
+                    keys.update(p.key for p in property_.props)
+
+                elif isinstance(property_, RelationshipProperty):
+                    # The foreign keys, to lazy load without an extra query
+                    keys.update(
+                        mapper_.get_property_by_column(column).key
+                        for column in property_.local_columns
+                    )
+
+                else:
+                    return None
+
+        return load_only(*keys)
 
     @classmethod
     def create_sort_criteria(cls, sort_columns):
         criteria = []
-        columns = {
-            cls.get_column_info(c).get('json'): c
-            for c in cls.iter_json_columns()
-        }
+        index = cls.get_json_index()
         for column_name, option in sort_columns:
-            if column_name in columns:
-                criteria.append((columns[column_name], option == 'desc'))
+            # The last one wins when several columns have the same name
+            columns = [
+                c for c in index.get(column_name, ()) if not c.protected
+            ]
+            if columns:
+                criteria.append((columns[-1].column, option == 'desc'))
         return criteria
 
     @classmethod
@@ -228,17 +409,80 @@ class BaseModel(object):
         if issubclass(cls, PaginationMixin):
             query = cls.paginate_by_request(query=query)
 
+        # Skipping the columns not requested by the ``fields``, unless the
+        # exported ones are customized by overriding the ``to_dict``. It's
+        # the last step, because the pagination may query other entities.
+        fields = cls.get_fields_by_request()
+        if fields is not None and cls.to_dict is BaseModel.to_dict:
+            option = cls.create_load_only_option(fields)
+            if option is not None:
+                query = query.options(option)
+
         return query
 
     @classmethod
-    def dump_query(cls, query=None):
+    def dump_query(cls, query=None, stream=False):
+        if stream:
+            return cls.iter_dump_query(query)
+
+        fields = cls.get_fields_by_request()
         result = []
-        for o in cls.filter_paginate_sort_query_by_request(query):
-            result.append(o.to_dict())
+        for o in cls.iter_query_by_request(query):
+            result.append(cls.export_fields(o, fields))
         return result
 
     @classmethod
-    def expose(cls, func):
+    def iter_query_by_request(cls, query=None, chunk_size=None):
+        """Yields the objects of the filtered, sorted and paginated query,
+        fetched by a server side cursor if the `chunk_size` is given.
+        """
+        query = cls.filter_paginate_sort_query_by_request(query)
+        if chunk_size:
+            query = query.yield_per(chunk_size)
+
+        if issubclass(cls, PaginationMixin):
+            return cls.iter_paginated(query)
+
+        return iter(query)
+
+    @classmethod
+    def iter_dump_query(cls, query=None, chunk_size=None):
+        """Yields the JSON array of the :meth:`dump_query` as strings, each
+        one holding up to `chunk_size` objects.
+
+        The rows are fetched by a server side cursor, so the memory usage
+        does not depend on the number of them. Nothing is fetched until the
+        first ``next()``, which nanohttp calls on a generator response
+        before starting it, so the errors of the first chunk are raised
+        before the response is started.
+        """
+        chunk_size = chunk_size or cls.__stream_chunk_size__
+        fields = cls.get_fields_by_request()
+        rows = cls.iter_query_by_request(query, chunk_size)
+        prefix = '['
+        while True:
+            chunk = [
+                ujson.dumps(cls.export_fields(o, fields))
+                for o in itertools.islice(rows, chunk_size)
+            ]
+            if not chunk:
+                break
+
+            yield prefix + ','.join(chunk)
+            prefix = ','
+
+        yield '[]' if prefix == '[' else ']'
+
+    @classmethod
+    def expose(cls, func=None, stream=False):
+        """Dumps the queries returned by the decorated handler.
+
+        Use it as ``@Model.expose(stream=True)`` within an action of the
+        ``application/json`` content type, instead of the ``@json``, to
+        stream the result using the :meth:`iter_dump_query`.
+        """
+        if func is None:
+            return functools.partial(cls.expose, stream=stream)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -246,7 +490,11 @@ class BaseModel(object):
             if result is None:
                 raise HTTPNotFound()
             if isinstance(result, Query):
-                return cls.dump_query(result)
+                return cls.dump_query(result, stream=stream)
+            if stream:
+                return ujson.dumps(
+                    result.to_dict() if hasattr(result, 'to_dict') else result
+                )
             return result
 
         return wrapper
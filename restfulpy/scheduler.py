@@ -0,0 +1,198 @@
+import time
+from datetime import datetime, timedelta
+
+from nanohttp import settings
+from sqlalchemy import Unicode, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from . import logger
+from .orm import DeclarativeBase, Field, DBSession, \
+    create_thread_unsafe_session
+from .taskqueue import RestfulpyTask
+
+
+class Cron:
+    """A minimal cron expression: ``minute hour day-of-month month
+    day-of-week``.
+
+    Each field accepts ``*``, numbers, ranges (``a-b``), steps (``*/n``,
+    ``a-b/n``) and comma separated lists of them. As the classic cron, when
+    both of day fields are restricted, a day matching either one is due.
+    All times are naive UTC, like the ``created_at`` of the models.
+    """
+
+    fields = (
+        ('minute', 0, 59),
+        ('hour', 0, 23),
+        ('day', 1, 31),
+        ('month', 1, 12),
+        ('weekday', 0, 7),
+    )
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != len(self.fields):
+            raise ValueError(f'Invalid cron expression: {expression}')
+
+        for part, (name, minimum, maximum) in zip(parts, self.fields):
+            setattr(self, name, self._parse(part, minimum, maximum))
+
+        # Both 0 and 7 are Sunday
+        if 7 in self.weekday:
+            self.weekday = (self.weekday - {7}) | {0}
+
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def _parse(self, field, minimum, maximum):
+        result = set()
+        for item in field.split(','):
+            range_, _, step = item.partition('/')
+            step = int(step) if step else 1
+
+            if range_ == '*':
+                start, end = minimum, maximum
+            elif '-' in range_:
+                start, end = (int(i) for i in range_.split('-'))
+            else:
+                start = int(range_)
+                end = maximum if step > 1 else start
+
+            if start < minimum or end > maximum or start > end or step < 1:
+                raise ValueError(
+                    f'Invalid cron expression: {self.expression}'
+                )
+
+            result.update(range(start, end + 1, step))
+
+        return result
+
+    def _day_matches(self, t):
+        day = t.day in self.day
+        # Python's weekday starts from Monday
+        weekday = (t.weekday() + 1) % 7 in self.weekday
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def next(self, after):
+        """Returns the first due time strictly after the given one."""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+
+        # Five years are enough to find the leap days, more means that the
+        # expression is never due, i.e: 30 of February.
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.month:
+                year, month = divmod(t.month, 12)
+                t = t.replace(year=t.year + year, month=month + 1, day=1,
+                              hour=0, minute=0)
+
+            elif not self._day_matches(t):
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+
+            elif t.hour not in self.hour:
+                t = (t + timedelta(hours=1)).replace(minute=0)
+
+            elif t.minute not in self.minute:
+                t += timedelta(minutes=1)
+
+            else:
+                return t
+
+        raise ValueError(f'Cron expression is never due: {self.expression}')
+
+
+class ScheduledJob(DeclarativeBase):
+    """Tracks the next due time of each recurring task type, so several
+    schedulers could run side by side without enqueuing a job twice.
+    """
+
+    __tablename__ = 'restfulpy_job'
+
+    name = Field(Unicode(50), primary_key=True, json='name')
+    next_run_at = Field(DateTime, nullable=False, json='nextRunAt')
+
+
+def iter_recurring_task_types():
+    """Yields the ``(name, class)`` of the tasks having a ``__cron__``."""
+    for name, mapper in RestfulpyTask.__mapper__.polymorphic_map.items():
+        if getattr(mapper.class_, '__cron__', None):
+            yield name, mapper.class_
+
+
+def schedule(session=DBSession, now=None, batch_size=None):
+    """Enqueues the due recurring jobs, returns the number of new tasks.
+
+    The tasks are created with the due time as their ``run_at``, missed runs
+    are coalesced into one, and at most `batch_size` jobs are handled.
+    """
+    now = now or datetime.utcnow()
+    batch_size = batch_size or settings.jobs.batch_size
+    types = dict(iter_recurring_task_types())
+    if not types:
+        return 0
+
+    session.execute(
+        insert(ScheduledJob.__table__)
+        .values([
+            dict(name=k, next_run_at=Cron(v.__cron__).next(now))
+            for k, v in types.items()
+        ])
+        .on_conflict_do_nothing()
+    )
+
+    due_jobs = session.query(ScheduledJob) \
+        .filter(ScheduledJob.name.in_(list(types))) \
+        .filter(ScheduledJob.next_run_at <= now) \
+        .order_by(ScheduledJob.next_run_at) \
+        .limit(batch_size) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+    for job in due_jobs:
+        task_type = types[job.name]
+        session.add(task_type(run_at=job.next_run_at))
+        job.next_run_at = Cron(task_type.__cron__).next(
+            max(now, job.next_run_at)
+        )
+
+    session.commit()
+    return len(due_jobs)
+
+
+def scheduler(tries=-1, stop=None, batch_size=None):
+    isolated_session = create_thread_unsafe_session()
+    batch_size = batch_size or settings.jobs.batch_size
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                count = schedule(
+                    session=isolated_session,
+                    batch_size=batch_size
+                )
+            except:
+                logger.error('Error when scheduling jobs.')
+                isolated_session.rollback()
+                raise
+
+            logger.debug('%d job(s) are enqueued' % count)
+
+            # A full batch, maybe there are more due jobs
+            if count >= batch_size:
+                continue
+
+            if tries > -1:
+                tries -= 1
+                if tries <= 0:
+                    return
+
+            if stop is not None:
+                stop.wait(settings.jobs.interval)
+            else:
+                time.sleep(settings.jobs.interval)
+
+    finally:
+        isolated_session.close()
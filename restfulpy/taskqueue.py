@@ -1,23 +1,90 @@
+import asyncio
+import ctypes
+import json
+import os
+import random
+import select as select_
+import socket
+import sys
+import threading
 import time
 import traceback
-from datetime import datetime
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
 
 from nanohttp import settings
-from sqlalchemy import Integer, Enum, Unicode, DateTime
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import Integer, Enum, Unicode, DateTime, Index, select, \
+    func, or_, and_, inspect, case, literal_column, Table, Column, \
+    ForeignKey, union_all, Boolean, Interval, bindparam
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.events import event
+from sqlalchemy.ext import baked
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql.expression import text
 
 from . import logger
 from .exceptions import RestfulException
+from .metrics import WorkerMetrics
 from .orm import TimestampMixin, DeclarativeBase, Field, DBSession, \
-    create_thread_unsafe_session
+    create_thread_unsafe_session, metadata
+
+
+# Popped when their next attempt is due
+RETRY_STATUSES = ('retrying', 'timed-out')
+
+# The claim queries, compiled once per shape, see RestfulpyTask.pop_many
+_claim_bakery = baked.bakery()
 
 
 class TaskPopError(RestfulException):
     pass
 
 
+class TaskTimeoutError(RestfulException):
+    pass
+
+
 class RestfulpyTask(TimestampMixin, DeclarativeBase):
+    """The base class of the background tasks.
+
+    Retry policy could be customized per task type by overriding the
+    ``__max_attempts__``, ``__backoff__`` (seconds, doubled per attempt),
+    ``__max_backoff__`` and ``__jitter__`` (a fraction of the delay)
+    attributes. A task failing for ``__max_attempts__`` times would be
+    ``failed``, which is the terminal (dead-letter) status.
+
+    An attempt running longer than ``__timeout__`` seconds is interrupted
+    and recorded as ``timed-out``, which is retried like ``retrying`` while
+    there are attempts left, then it's ``failed``. Long running tasks could
+    check the ``cancelled`` event to stop cooperatively, see
+    :class:`.Watchdog`.
+
+    Workers could be kept from claiming too many tasks of a type by
+    ``__max_concurrency__`` and ``__rate_limit__`` (tasks per second), see
+    :class:`.TaskThrottle`.
+
+    Tasks having the same ``dedup_key`` are coalesced while they are
+    ``new``, see :meth:`enqueue_many`. Tasks depending on other ones are
+    ``blocked`` until their dependencies succeed, see :class:`.Workflow`.
+
+    The value returned by the ``do_`` is stored as the JSON ``result`` of
+    the task, see :func:`.wait`.
+    """
+
     __tablename__ = 'restfulpy_task'
+    __max_attempts__ = 1
+    __backoff__ = 10
+    __max_backoff__ = 3600
+    __jitter__ = .1
+    __timeout__ = None
+    __max_concurrency__ = None
+    __rate_limit__ = None
 
     id = Field(Integer, primary_key=True, json='id')
     priority = Field(Integer, nullable=False, default=50, json='priority')
@@ -27,6 +94,9 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
             'success',
             'in-progress',
             'failed',
+            'retrying',
+            'blocked',
+            'timed-out',
             name='task_status_enum'
         ),
         default='new',
@@ -35,6 +105,66 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
     fail_reason = Field(Unicode(4096), nullable=True, json='reason')
     started_at = Field(DateTime, nullable=True, json='startedAt')
     terminated_at = Field(DateTime, nullable=True, json='terminatedAt')
+    run_at = Field(DateTime, nullable=True, json='runAt')
+    attempts = Field(
+        Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        json='attempts',
+        readonly=True
+    )
+    next_attempt_at = Field(
+        DateTime,
+        nullable=True,
+        json='nextAttemptAt',
+        readonly=True
+    )
+    leased_until = Field(
+        DateTime,
+        nullable=True,
+        json='leasedUntil',
+        readonly=True
+    )
+    worker_id = Field(
+        Unicode(100),
+        nullable=True,
+        json='workerId',
+        readonly=True
+    )
+    dedup_key = Field(Unicode(200), nullable=True, json='dedupKey')
+    result = Field(
+        JSONB(none_as_null=True),
+        nullable=True,
+        json='result',
+        readonly=True
+    )
+    pending_dependencies = Field(
+        Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        json='pendingDependencies',
+        readonly=True
+    )
+    # The dependants are released, and the waiters are notified only when
+    # there is any, see: Workflow and wait.
+    has_dependants = Field(
+        Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+        json='hasDependants',
+        readonly=True
+    )
+    has_waiters = Field(
+        Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+        json='hasWaiters',
+        readonly=True
+    )
     type = Field(Unicode(50))
 
     __mapper_args__ = {
@@ -42,12 +172,313 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
         'polymorphic_on': type
     }
 
+    # Partial indexes matching the pop query, they stay small no matter how
+    # many finished tasks are there. The pop query scans the new index in
+    # order and stops as soon as enough tasks are found, the retries are
+    # looked up by the due time, the ones waiting for a backoff are never
+    # visited.
+    __table_args__ = (
+        Index(
+            'restfulpy_task_new_idx',
+            priority.desc(),
+            'created_at',
+            postgresql_where=status == 'new'
+        ),
+        Index(
+            'restfulpy_task_retry_idx',
+            next_attempt_at,
+            postgresql_where=status.in_(RETRY_STATUSES)
+        ),
+        Index(
+            'restfulpy_task_lease_idx',
+            leased_until,
+            postgresql_where=status == 'in-progress'
+        ),
+        Index(
+            'restfulpy_task_run_at_idx',
+            run_at,
+            postgresql_where=status == 'new'
+        ),
+        Index(
+            'restfulpy_task_failed_idx',
+            'created_at',
+            postgresql_where=status == 'failed'
+        ),
+        # Only the pending tasks are coalesced, a running task might have
+        # read the state its duplicate is enqueued for.
+        Index(
+            'restfulpy_task_dedup_key_idx',
+            dedup_key,
+            unique=True,
+            postgresql_where=status == 'new'
+        ),
+    )
+
     def do_(self):
         raise NotImplementedError
 
+    def get_retry_delay(self):
+        delay = min(
+            self.__backoff__ * 2 ** max(self.attempts - 1, 0),
+            self.__max_backoff__
+        )
+        return delay + random.uniform(0, delay * self.__jitter__)
+
+    def get_failure_values(self, reason, timed_out=False):
+        """Returns the column values of this task after a failed
+        attempt, according to the retry policy.
+
+        The ``next_attempt_at`` is :data:`None` when there is no attempt
+        left, and the task is ``failed`` even if it is timed out, so it
+        leaves the ready index and could be archived.
+        """
+        if self.attempts < self.__max_attempts__:
+            return dict(
+                status='timed-out' if timed_out else 'retrying',
+                fail_reason=reason,
+                next_attempt_at=datetime.utcnow() + timedelta(
+                    seconds=self.get_retry_delay()
+                )
+            )
+
+        return dict(
+            status='failed',
+            fail_reason=reason,
+            next_attempt_at=None
+        )
+
+    def fail(self, reason, timed_out=False):
+        for k, v in self.get_failure_values(reason, timed_out).items():
+            setattr(self, k, v)
+
+    @classmethod
+    def enqueue(cls, task, session=DBSession, notify=True):
+        """Enqueues a single task, see :meth:`enqueue_many`."""
+        return cls.enqueue_many([task], session=session, notify=notify)[0]
+
+    @classmethod
+    def enqueue_many(cls, tasks, session=DBSession, notify=True,
+                     chunk_size=1000):
+        """Inserts the given (transient) tasks bypassing the unit of work.
+
+        Each chunk of the same task type costs one multi-row INSERT per
+        table of its inheritance hierarchy, and at most one notification per
+        task type is emitted. The caller is responsible to commit, the ids
+        of the new tasks are returned in the given order.
+
+        A task having the ``dedup_key`` of a ``new`` task is merged into
+        it instead: the higher priority and the earlier ``run_at`` are
+        kept, and the id of the pending task is returned for it.
+        """
+        tasks = list(tasks)
+        ids = {}
+        groups = {}
+        for task in tasks:
+            groups.setdefault(inspect(type(task)), []).append(task)
+
+        for mapper, group in groups.items():
+            tables = []
+            for m in reversed(list(mapper.iterate_to_root())):
+                if m.local_table not in tables:
+                    tables.append(m.local_table)
+
+            inserted = False
+            for i in range(0, len(group), chunk_size):
+                base_table, *sub_tables = tables
+                chunk, rows, owners = _coalesce(
+                    mapper,
+                    base_table,
+                    group[i:i + chunk_size]
+                )
+                chunk_ids, created = _upsert(session, base_table, rows)
+                new_tasks = [
+                    (t, id_) for t, id_, c in zip(chunk, chunk_ids, created)
+                    if c
+                ]
+                for table in sub_tables:
+                    if not new_tasks:
+                        break
+
+                    session.execute(table.insert().values([
+                        _get_column_values(mapper, table, t, id_)
+                        for t, id_ in new_tasks
+                    ]))
+
+                inserted = inserted or bool(new_tasks)
+                ids.update(
+                    (k, chunk_ids[v]) for k, v in owners.items()
+                )
+
+            if notify and inserted:
+                session.execute(
+                    text('SELECT pg_notify(:channel, :payload)'),
+                    dict(
+                        channel=settings.worker.channel,
+                        payload=mapper.polymorphic_identity or ''
+                    )
+                )
+
+        return [ids[id(t)] for t in tasks]
+
+    @classmethod
+    def get_ready_criteria(cls, statuses={'new'}, expired_leases=True):
+        """Returns the criteria of the tasks could be popped right now."""
+        criteria = or_(
+            cls.get_pending_criteria(statuses),
+            cls.get_due_retry_criteria()
+        )
+        if expired_leases and cls.reclaims_expired_leases(statuses):
+            criteria = or_(criteria, cls.get_expired_lease_criteria())
+
+        return criteria
+
+    @classmethod
+    def get_pending_criteria(cls, statuses={'new'}):
+        return and_(
+            cls.status.in_(sorted(statuses)),
+            or_(
+                cls.run_at.is_(None),
+                cls.run_at <= func.timezone('utc', func.now())
+            )
+        )
+
+    @classmethod
+    def get_due_retry_criteria(cls):
+        return and_(
+            cls.status.in_(RETRY_STATUSES),
+            cls.next_attempt_at <= func.timezone('utc', func.now())
+        )
+
+    @classmethod
+    def get_expired_lease_criteria(cls):
+        return and_(
+            cls.status == 'in-progress',
+            cls.leased_until < func.timezone('utc', func.now())
+        )
+
+    @staticmethod
+    def reclaims_expired_leases(statuses):
+        return bool(settings.worker.lease) and 'in-progress' not in statuses
+
+    @classmethod
+    def count_ready(cls, statuses={'new'}, filters=None, limit=None,
+                    session=DBSession):
+        """Returns the number of the tasks could be popped right now, the
+        counting stops at `limit` to keep it cheap for a long queue.
+        """
+        query = session.query(cls.id).filter(cls.get_ready_criteria(statuses))
+        if filters is not None:
+            query = query.filter(
+                text(filters) if isinstance(filters, str) else filters
+            )
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return session.query(func.count()).select_from(query.subquery()) \
+            .scalar()
+
     @classmethod
-    def pop(cls, statuses={'new'}, filters=None, session=DBSession):
+    def count_in_progress(cls, worker_prefixes, session=DBSession):
+        """Returns the number of the tasks held by the workers having any of
+        the given prefixes, see :func:`.create_worker_id`.
+        """
+        if not worker_prefixes:
+            return 0
+
+        return session.query(func.count(cls.id)) \
+            .filter(cls.status == 'in-progress') \
+            .filter(or_(*[
+                cls.worker_id.startswith(p) for p in worker_prefixes
+            ])) \
+            .scalar()
+
+    @classmethod
+    def pop(cls, statuses={'new'}, filters=None, session=DBSession,
+            worker_id=None, excluded_types=None):
+        return cls.pop_many(
+            1,
+            statuses=statuses,
+            filters=filters,
+            session=session,
+            worker_id=worker_id,
+            excluded_types=excluded_types
+        )[0]
+
+    @classmethod
+    def pop_many(cls, count, statuses={'new'}, filters=None,
+                 session=DBSession, worker_id=None, excluded_types=None,
+                 type_limits=None):
+        """Claims up to `count` tasks in a single round-trip.
+
+        Rows locked by another worker are skipped instead of waited for, so
+        concurrent workers never serialize on the head of the queue.
+
+        Tasks having a ``run_at`` in the future (naive UTC) are skipped, and
+        the ``retrying`` and ``timed-out`` ones are popped when their next
+        attempt is due.
+
+        When ``settings.worker.lease`` is set, the claimed tasks are leased to
+        `worker_id` and in-progress tasks with an expired lease are
+        reclaimed as well.
+
+        At most ``type_limits[type]`` tasks of each type given in the
+        `type_limits` dictionary are claimed.
+        """
+        lease = settings.worker.lease
+        type_limits = type_limits or {}
+        limited_types = tuple(sorted(type_limits))
+        excluded_types = frozenset(excluded_types or ())
+
+        # Building and compiling the statement costs more than executing it,
+        # so it's done once per shape of the claim and the values are bound
+        # on each call.
+        query = _claim_bakery(
+            lambda s: cls._create_claim_query(
+                s,
+                statuses,
+                filters,
+                excluded_types,
+                limited_types,
+                bool(lease)
+            ),
+            cls,
+            frozenset(statuses),
+            filters,
+            excluded_types,
+            limited_types,
+            bool(lease)
+        )
+        params = dict(count=count, worker_id=worker_id)
+        if lease:
+            params['lease'] = timedelta(seconds=lease)
+
+        for i, type_ in enumerate(limited_types):
+            params[f'limit_{i}'] = min(type_limits[type_], count)
+
+        tasks = query(session).params(**params).all()
+
+        # The outer select sees the snapshot taken before the update
+        for task in tasks:
+            set_committed_value(task, 'status', 'in-progress')
+            set_committed_value(task, 'worker_id', worker_id)
+            set_committed_value(task, 'attempts', task.attempts + 1)
+            session.expire(task, ['leased_until'])
+
+        session.commit()
+        if not tasks:
+            raise TaskPopError('There is no task to pop')
+
+        return tasks
 
+    @classmethod
+    def _create_claim_query(cls, session, statuses, filters, excluded_types,
+                            limited_types, lease):
+        """Returns the query claiming and loading the tasks, the batch size,
+        the limit of each type, the worker id and the lease are bound as the
+        ``count``, ``limit_<i>``, ``worker_id`` and ``lease`` parameters.
+        """
+        count = bindparam('count', type_=Integer)
         find_query = session.query(
             cls.id.label('id'),
             cls.created_at,
@@ -60,40 +491,217 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
                 text(filters) if isinstance(filters, str) else filters
             )
 
-        find_query = find_query \
-            .filter(cls.status.in_(statuses)) \
-            .order_by(cls.priority.desc()) \
-            .order_by(cls.created_at) \
-            .limit(1) \
-            .with_for_update()
+        if excluded_types:
+            find_query = find_query.filter(
+                cls.type.notin_(sorted(excluded_types))
+            )
+
+        # The due retries and the expired leases are looked up separately,
+        # an OR of them would not let the planner to scan the new index in
+        # order.
+        unlimited = cls.type.notin_(limited_types) if limited_types \
+            else True
+        branches = [
+            (and_(cls.get_pending_criteria(statuses), unlimited), count),
+            (and_(cls.get_due_retry_criteria(), unlimited), count),
+        ]
+        if cls.reclaims_expired_leases(statuses):
+            branches.append((
+                and_(cls.get_expired_lease_criteria(), unlimited),
+                count
+            ))
 
-        cte = find_query.cte('find_query')
+        # Each limited type is claimed by its own branch
+        for i, type_ in enumerate(limited_types):
+            branches.append((
+                and_(cls.get_ready_criteria(statuses), cls.type == type_),
+                bindparam(f'limit_{i}', type_=Integer)
+            ))
 
-        update_query = RestfulpyTask.__table__.update() \
+        cte = cls._create_find_query(find_query, branches, count)
+
+        values = dict(
+            status='in-progress',
+            worker_id=bindparam('worker_id', type_=Unicode),
+            attempts=RestfulpyTask.attempts + 1
+        )
+        if lease:
+            values['leased_until'] = func.timezone('utc', func.now()) \
+                + bindparam('lease', type_=Interval)
+
+        claimed = RestfulpyTask.__table__.update() \
             .where(RestfulpyTask.id == cte.c.id) \
-            .values(status='in-progress') \
-            .returning(RestfulpyTask.__table__.c.id)
+            .values(**values) \
+            .returning(RestfulpyTask.__table__.c.id) \
+            .cte('claimed')
 
-        task_id = session.execute(update_query).fetchone()
-        session.commit()
-        if not task_id:
-            raise TaskPopError('There is no task to pop')
-        task_id = task_id[0]
-        task = session.query(cls).filter(cls.id == task_id).one()
-        return task
+        # Claiming and loading the whole polymorphic rows in one statement.
+        return session.query(cls) \
+            .with_polymorphic('*') \
+            .populate_existing() \
+            .filter(cls.id.in_(select([claimed.c.id]))) \
+            .order_by(cls.priority.desc()) \
+            .order_by(cls.created_at)
+
+    @classmethod
+    def _create_find_query(cls, query, branches, count):
+        """Locks up to `count` tasks matching any of the ``(criteria,
+        limit)`` branches, each one in its own CTE, because a locking clause
+        is not allowed within a ``UNION``.
+        """
+        ctes = [
+            query
+            .filter(criteria)
+            .order_by(cls.priority.desc())
+            .order_by(cls.created_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .cte(f'find_query_{i}')
+            for i, (criteria, limit) in enumerate(branches)
+        ]
+        if len(ctes) == 1:
+            return ctes[0]
+
+        candidates = union_all(*[
+            select([c.c.id, c.c.priority, c.c.created_at]) for c in ctes
+        ]).alias('candidates')
+        return select([candidates.c.id]) \
+            .order_by(candidates.c.priority.desc()) \
+            .order_by(candidates.c.created_at) \
+            .limit(count) \
+            .cte('find_query')
 
     def execute(self, context, session=DBSession):
         try:
-            isolated_task = session \
-                .query(RestfulpyTask) \
-                .filter(RestfulpyTask.id == self.id) \
-                .one()
-            isolated_task.do_(context)
+            result = self.do_(context)
             session.commit()
+            return result
         except:
             session.rollback()
             raise
 
+    @classmethod
+    def release_dependants(cls, ids, session=DBSession):
+        """Should be called when the given tasks are succeeded, in the same
+        transaction, returns the ids of the released dependants.
+
+        The edges of the given tasks are consumed, so releasing a task twice
+        is harmless. The dependants are locked in the order of their ids, so
+        the concurrent releases could not deadlock.
+
+        A released dependant having the ``dedup_key`` of a ``new`` task, or
+        of another dependant released along with it, loses its key instead
+        of violating the uniqueness of the pending keys.
+
+        The workers are notified of the released dependants when the
+        transaction commits.
+        """
+        if not ids:
+            return []
+
+        result = session.execute(text(
+            'WITH edges AS (DELETE FROM restfulpy_task_dependency '
+            'WHERE dependency_id IN :ids RETURNING task_id), '
+            'finished AS (SELECT task_id, count(*) AS count FROM edges '
+            'GROUP BY task_id), '
+            'locked AS (SELECT t.id, t.dedup_key, finished.count, '
+            't.status = \'blocked\' '
+            'AND t.pending_dependencies <= finished.count AS released '
+            'FROM restfulpy_task t '
+            'JOIN finished ON finished.task_id = t.id '
+            'ORDER BY t.id FOR UPDATE OF t), '
+            'keyed AS (SELECT id, dedup_key, row_number() OVER '
+            '(PARTITION BY dedup_key ORDER BY id) AS rank FROM locked '
+            'WHERE released AND dedup_key IS NOT NULL), '
+            'duplicates AS (SELECT id FROM keyed WHERE rank > 1 '
+            'OR EXISTS (SELECT 1 FROM restfulpy_task p '
+            'WHERE p.dedup_key = keyed.dedup_key AND p.status = \'new\')) '
+            'UPDATE restfulpy_task SET '
+            'pending_dependencies = pending_dependencies - locked.count, '
+            'status = CASE WHEN locked.released '
+            'THEN \'new\' ELSE status END, '
+            'dedup_key = CASE WHEN locked.id IN (SELECT id FROM duplicates) '
+            'THEN NULL ELSE restfulpy_task.dedup_key END '
+            'FROM locked WHERE restfulpy_task.id = locked.id '
+            'RETURNING restfulpy_task.id, restfulpy_task.status, '
+            'restfulpy_task.type'
+        ), dict(ids=tuple(ids)))
+        released = [(id_, type_) for id_, status, type_ in result
+                    if status == 'new']
+        for type_ in sorted({t or '' for _, t in released}):
+            session.execute(
+                text('SELECT pg_notify(:channel, :payload)'),
+                dict(channel=settings.worker.channel, payload=type_)
+            )
+
+        return [id_ for id_, _ in released]
+
+    @classmethod
+    def fail_dependants(cls, ids, session=DBSession):
+        """Should be called when the given tasks are failed for good, fails
+        all of the blocked tasks depending on them, directly or not, and
+        returns their ids.
+        """
+        if not ids:
+            return []
+
+        result = session.execute(text(
+            'WITH RECURSIVE dependants(id) AS ('
+            'SELECT task_id FROM restfulpy_task_dependency '
+            'WHERE dependency_id IN :ids '
+            'UNION SELECT e.task_id FROM restfulpy_task_dependency e '
+            'JOIN dependants ON e.dependency_id = dependants.id) '
+            'UPDATE restfulpy_task SET status = \'failed\', '
+            'fail_reason = :reason, '
+            'terminated_at = timezone(\'utc\', now()) '
+            'WHERE id IN (SELECT id FROM dependants) '
+            'AND status = \'blocked\' RETURNING id'
+        ), dict(ids=tuple(ids), reason='A dependency is failed'))
+        return [r[0] for r in result]
+
+    @classmethod
+    def notify_finished(cls, ids, session=DBSession):
+        """Announces the given finished tasks having any waiter, the
+        notifications are delivered when the transaction commits.
+
+        The finished rows should be updated beforehand in the same
+        transaction, so a waiter could not flag them meanwhile, see
+        :func:`.wait`.
+        """
+        if not ids:
+            return
+
+        session.execute(
+            text(
+                'SELECT pg_notify(:channel, CAST(id AS text)) '
+                'FROM restfulpy_task WHERE id = ANY(CAST(:ids AS integer[])) '
+                'AND has_waiters'
+            ),
+            dict(channel=settings.worker.result_channel, ids=list(ids))
+        )
+
+    @classmethod
+    def get_queue_depth(cls, session=DBSession):
+        """Returns the number of unfinished and failed tasks by their
+        ``(status, priority)``.
+
+        Succeeded tasks are not counted, they are not a part of the queue and
+        counting them would scan the whole table.
+        """
+        statuses = [
+            'new',
+            'in-progress',
+            'retrying',
+            'failed',
+            'blocked',
+            'timed-out'
+        ]
+        rows = session.query(cls.status, cls.priority, func.count()) \
+            .filter(cls.status.in_(statuses)) \
+            .group_by(cls.status, cls.priority) \
+            .all()
+        return {(status, priority): count for status, priority, count in rows}
+
     @classmethod
     def cleanup(cls, session=DBSession, filters=None, statuses=['in-progress']):
         cleanup_query = session.query(RestfulpyTask) \
@@ -104,11 +712,19 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
                 text(filters) if isinstance(filters, str) else filters
             )
 
+        # The dedup keys are dropped, the reset tasks may collide with their
+        # pending duplicates otherwise.
         cleanup_query.with_for_update() \
             .update({
                 'status': 'new',
                 'started_at': None,
-                'terminated_at': None
+                'terminated_at': None,
+                'leased_until': None,
+                'worker_id': None,
+                'attempts': 0,
+                'next_attempt_at': None,
+                'dedup_key': None,
+                'result': None
             }, synchronize_session='fetch')
 
     @classmethod
@@ -121,53 +737,1126 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
             .update({
                 'status': 'new',
                 'started_at': None,
-                'terminated_at': None
+                'terminated_at': None,
+                'leased_until': None,
+                'worker_id': None,
+                'attempts': 0,
+                'next_attempt_at': None,
+                'dedup_key': None,
+                'result': None
             }, synchronize_session='fetch')
 
 
-def worker(statuses={'new'}, filters=None, tries=-1):
-    isolated_session = create_thread_unsafe_session()
-    context = {'counter': 0}
-    tasks = []
+def _notify_inserted_tasks(session, flush_context):
+    # Delivered by PostgreSQL when the enqueuing transaction commits, a
+    # single notification per flush lists the types of the inserted tasks.
+    types = {
+        t.type or '' for t in session.new if isinstance(t, RestfulpyTask)
+    }
+    if not types or not settings.worker.listen:
+        return
+
+    session.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        dict(channel=settings.worker.channel, payload=','.join(sorted(types)))
+    )
+
+
+event.listen(Session, 'after_flush', _notify_inserted_tasks)
+
+
+task_dependency_table = Table(
+    'restfulpy_task_dependency',
+    metadata,
+    Column(
+        'task_id',
+        Integer,
+        ForeignKey('restfulpy_task.id', ondelete='CASCADE'),
+        primary_key=True
+    ),
+    Column(
+        'dependency_id',
+        Integer,
+        ForeignKey('restfulpy_task.id', ondelete='CASCADE'),
+        primary_key=True
+    ),
+    Index('restfulpy_task_dependency_dependency_id_idx', 'dependency_id'),
+)
+
+
+class Workflow:
+    """Enqueues a graph of tasks at once.
+
+    A task added with `depends_on` is ``blocked`` until all of its
+    dependencies succeed, then the worker finishing the last one releases it
+    in the same transaction. It fails if any of its dependencies fails. So a
+    chain is a task depending on the previous one, and a fan-in is a task
+    depending on all of the fanned out ones::
+
+        workflow = Workflow()
+        pages = [workflow.add(ExportPageTask(page=i)) for i in range(500)]
+        workflow.add(MergeExportTask(), depends_on=pages)
+        workflow.enqueue()
+
+    The dependencies should be added to the same workflow beforehand, so
+    the graph could not have a cycle.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.dependencies = []
+
+    def add(self, task, depends_on=()):
+        added = {id(t) for t in self.tasks}
+        dependencies = {}
+        for dependency in depends_on:
+            if id(dependency) not in added:
+                raise ValueError(
+                    'The dependency should be added to the workflow first'
+                )
+
+            dependencies[id(dependency)] = dependency
+
+        self.tasks.append(task)
+        self.dependencies.append(list(dependencies.values()))
+        return task
+
+    def enqueue(self, session=DBSession, notify=True):
+        """Enqueues the tasks and their dependency edges, returns the ids of
+        the tasks. The caller is responsible to commit.
+        """
+        for task, dependencies in zip(self.tasks, self.dependencies):
+            if dependencies:
+                task.status = 'blocked'
+                task.pending_dependencies = len(dependencies)
+
+            for dependency in dependencies:
+                dependency.has_dependants = True
+
+        ids = RestfulpyTask.enqueue_many(
+            self.tasks,
+            session=session,
+            notify=notify
+        )
+        indexes = {id(t): i for i, t in enumerate(self.tasks)}
+
+        # Dependencies coalesced by their dedup_key make a single edge
+        edges = {
+            (ids[i], ids[indexes[id(d)]])
+            for i, dependencies in enumerate(self.dependencies)
+            for d in dependencies
+        }
+        if not edges:
+            return ids
+
+        session.execute(task_dependency_table.insert().values([
+            dict(task_id=t, dependency_id=d) for t, d in sorted(edges)
+        ]))
+
+        counts = Counter(t for t, _ in edges)
+        for i, task in enumerate(self.tasks):
+            if task.pending_dependencies and \
+                    counts[ids[i]] != task.pending_dependencies:
+                session.execute(
+                    RestfulpyTask.__table__.update()
+                    .where(RestfulpyTask.id == ids[i])
+                    .values(pending_dependencies=counts[ids[i]])
+                )
+
+        return ids
+
+
+def _get_column_values(mapper, table, task, id_=None):
+    values = {}
+    for column in table.columns:
+        if column.primary_key:
+            if id_ is not None:
+                values[column.key] = id_
+            continue
+
+        value = getattr(task, mapper.get_property_by_column(column).key)
+        if value is None and column.default is not None:
+            value = column.default.arg(None) if column.default.is_callable \
+                else column.default.arg
+
+        values[column.key] = value
+
+    return values
+
+
+def _coalesce(mapper, table, tasks):
+    """Merges the tasks having the same ``dedup_key``, because a row could
+    not be upserted twice by a statement.
+
+    Returns the distinct tasks, their column values and the index of the
+    distinct task of each given task by its :func:`id`.
+    """
+    distinct = []
+    rows = []
+    owners = {}
+    keys = {}
+    for task in tasks:
+        values = _get_column_values(mapper, table, task)
+
+        # Like the dedup index, only the new ones, a blocked task should not
+        # be merged into a runnable one.
+        key = task.dedup_key if values['status'] == 'new' else None
+        index = keys.get(key) if key is not None else None
+
+        if index is None:
+            index = len(rows)
+            distinct.append(task)
+            rows.append(values)
+            if key is not None:
+                keys[key] = index
+
+        else:
+            row = rows[index]
+            row['priority'] = max(row['priority'], values['priority'])
+            row['run_at'] = None if None in (row['run_at'], values['run_at']) \
+                else min(row['run_at'], values['run_at'])
+            row['has_dependants'] = \
+                row['has_dependants'] or values['has_dependants']
+
+        owners[id(task)] = index
+
+    return distinct, rows, owners
+
+
+def _upsert(session, table, rows):
+    """Upserts the coalesced rows, returns the id of each one and whether it
+    is inserted or merged into a pending task.
+
+    The order of the ``RETURNING`` rows is not guaranteed to be the order of
+    the ``VALUES``, so the ids are reserved beforehand, and the merged rows
+    are told by their ``dedup_key``.
+    """
+    reserved = [id_ for id_, in session.execute(
+        text(
+            'SELECT nextval(pg_get_serial_sequence(:table, \'id\')) '
+            'FROM generate_series(1, :count)'
+        ),
+        dict(table=table.fullname, count=len(rows))
+    )]
+    indexes = {}
+    keys = {}
+    for index, (row, id_) in enumerate(zip(rows, reserved)):
+        row['id'] = id_
+        indexes[id_] = index
+        if row['status'] == 'new' and row['dedup_key'] is not None:
+            keys[row['dedup_key']] = index
+
+    ids = list(reserved)
+    created = [False] * len(rows)
+    for id_, dedup_key, inserted in session.execute(
+            _create_upsert_statement(table, rows)):
+        if inserted:
+            created[indexes[id_]] = True
+
+        else:
+            ids[keys[dedup_key]] = id_
+
+    return ids, created
+
+
+def _create_upsert_statement(table, rows):
+    statement = insert(table).values(rows)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.dedup_key],
+        index_where=table.c.status == 'new',
+        set_=dict(
+            priority=func.greatest(table.c.priority, excluded.priority),
+            run_at=case(
+                [(
+                    or_(table.c.run_at.is_(None), excluded.run_at.is_(None)),
+                    None
+                )],
+                else_=func.least(table.c.run_at, excluded.run_at)
+            ),
+            has_dependants=or_(
+                table.c.has_dependants,
+                excluded.has_dependants
+            )
+        )
+    ).returning(
+        table.c.id,
+        table.c.dedup_key,
+        # The rows having no xmax are inserted, not updated
+        literal_column('xmax = 0')
+    )
+
+
+OBSOLETE_INDEXES = (
+    'restfulpy_task_ready_idx',
+    'restfulpy_task_retrying_idx',
+    'restfulpy_task_timed_out_idx',
+)
+
+
+def upgrade_schema(engine):
+    """Brings the ``restfulpy_task`` table of an existing deployment up to
+    date: adds the missing status values, columns, indexes, the dependency
+    and the scheduled jobs tables, drops the obsolete indexes and fails the
+    exhausted timed-out tasks. The missing columns of the archive table are
+    added as well.
+
+    All statements are executed in autocommit mode and the indexes are built
+    concurrently, so the queue is not locked meanwhile. Running it again is
+    harmless.
+    """
+    table = RestfulpyTask.__table__
+    dialect = engine.dialect
+    ddl = dialect.ddl_compiler(dialect, None)
+    inspector = inspect(engine)
+
+    # The archive, if any, mirrors the columns of the task table
+    tables = [table]
+    archive_table = table.metadata.tables.get('restfulpy_task_archive')
+    if archive_table is not None \
+            and archive_table.name in inspector.get_table_names():
+        tables.append(archive_table)
+
+    from .scheduler import ScheduledJob
+
+    connection = engine.connect() \
+        .execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        task_dependency_table.create(bind=connection, checkfirst=True)
+        ScheduledJob.__table__.create(bind=connection, checkfirst=True)
+
+        status_type = table.c.status.type
+        for value in status_type.enums:
+            connection.execute(
+                f'ALTER TYPE {status_type.name} '
+                f'ADD VALUE IF NOT EXISTS \'{value}\''
+            )
+
+        for t in tables:
+            existing_columns = {
+                c['name'] for c in inspector.get_columns(t.name)
+            }
+            for column in t.columns:
+                if column.name in existing_columns:
+                    continue
+
+                connection.execute(
+                    f'ALTER TABLE {t.name} '
+                    f'ADD COLUMN {ddl.get_column_specification(column)}'
+                )
+
+        for index in table.indexes:
+            statement = str(CreateIndex(index).compile(dialect=dialect))
+            connection.execute(statement.replace(
+                'INDEX',
+                'INDEX CONCURRENTLY IF NOT EXISTS',
+                1
+            ))
+
+        # Superseded by the restfulpy_task_retry_idx
+        for name in OBSOLETE_INDEXES:
+            connection.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+        # The timed-out tasks having no attempt left used to stay in the
+        # ready index
+        connection.execute(
+            'UPDATE restfulpy_task SET status = \'failed\' '
+            'WHERE status = \'timed-out\' AND next_attempt_at IS NULL'
+        )
+    finally:
+        connection.close()
+
+
+class TaskListener:
+    """Blocks until a new task is announced via PostgreSQL's NOTIFY.
+
+    A dedicated connection is detached from the engine's pool, because it
+    has to stay in autocommit mode for the lifetime of the listener.
+    """
+
+    def __init__(self, engine, channel=None):
+        self.channel = channel or settings.worker.channel
+        fairy = engine.raw_connection()
+        fairy.detach()
+        self.connection = fairy.connection
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.connection.cursor()
+        cursor.execute(f'LISTEN "{self.channel}"')
+        cursor.close()
+
+    def receive(self, timeout):
+        """Returns the payloads of the notifications arrived before the
+        `timeout` (in seconds) expired.
+        """
+        if not self.connection.notifies:
+            readable, _, _ = select_.select([self.connection], [], [], timeout)
+            if not readable:
+                return []
+
+            self.connection.poll()
+
+        payloads = [n.payload for n in self.connection.notifies]
+        self.connection.notifies.clear()
+        return payloads
+
+    def wait(self, timeout):
+        """Returns :data:`True` if any notification arrived before
+        the `timeout` (in seconds) expired, otherwise :data:`False`.
+        """
+        return bool(self.receive(timeout))
+
+    def close(self):
+        self.connection.close()
+
+
+class ResultWaiter(threading.Thread):
+    """Wakes up the threads waiting for tasks to finish, all of them share
+    a single listening connection.
+
+    The connection is re-established when it fails, and all of the waiters
+    are woken up to check their tasks, because the notifications might be
+    missed meanwhile.
+    """
+
+    def __init__(self, engine, channel=None):
+        super().__init__(name='restfulpy-result-waiter', daemon=True)
+        self.pid = os.getpid()
+        self.engine = engine
+        self.channel = channel or settings.worker.result_channel
+        self.listener = TaskListener(engine, self.channel)
+        self.lock = threading.Lock()
+        self.events = {}
+        self.stopped = threading.Event()
+
+    def register(self, task_id):
+        ready = threading.Event()
+        with self.lock:
+            self.events.setdefault(task_id, set()).add(ready)
+
+        return ready
+
+    def unregister(self, task_id, ready):
+        with self.lock:
+            events = self.events.get(task_id)
+            events.discard(ready)
+            if not events:
+                del self.events[task_id]
+
+    def wake_up_all(self):
+        with self.lock:
+            for events in self.events.values():
+                for ready in events:
+                    ready.set()
+
+    def reconnect(self):
+        try:
+            self.listener.close()
+        except Exception:
+            pass
+
+        while not self.stopped.wait(settings.worker.gap):
+            try:
+                self.listener = TaskListener(self.engine, self.channel)
+                return True
+            except Exception:
+                logger.error('Cannot reconnect the result waiter')
+
+        return False
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                payloads = self.listener.receive(settings.worker.gap)
+            except Exception:
+                logger.error('Error when receiving the results')
+                if not self.reconnect():
+                    return
+
+                self.wake_up_all()
+                continue
+
+            with self.lock:
+                for payload in payloads:
+                    for ready in self.events.get(int(payload), ()):
+                        ready.set()
+
+        self.listener.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+FINISHED_STATUSES = ('success', 'failed')
+
+_result_waiter = None
+_result_waiter_lock = threading.Lock()
+
+
+def _get_result_waiter(engine):
+    global _result_waiter
+    with _result_waiter_lock:
+        # The listening connection could not be shared with a forked child
+        if _result_waiter is None or _result_waiter.pid != os.getpid() \
+                or not _result_waiter.is_alive():
+            _result_waiter = ResultWaiter(engine)
+            _result_waiter.start()
+
+        return _result_waiter
+
+
+def stop_result_waiter():
+    """Stops the shared listener of the :func:`.wait`, if any, it would be
+    started again by the next call. Should be called before disposing the
+    engine, i.e: when tearing down a test.
+    """
+    global _result_waiter
+    with _result_waiter_lock:
+        waiter, _result_waiter = _result_waiter, None
+        if waiter is not None and waiter.pid == os.getpid() \
+                and waiter.is_alive():
+            waiter.stop()
+
+
+def wait(task_id, timeout, session=DBSession):
+    """Blocks until the task is finished, returns the task or :data:`None`
+    if the `timeout` (in seconds) is expired.
+
+    The waiters are woken up by the notifications of the workers, so the
+    task is queried once per wake up, not polled. The enqueuing transaction
+    should be committed beforehand.
+
+    The task is flagged by ``has_waiters`` in its own transaction, before
+    its status is checked, so the workers notify only the waited tasks.
+    """
+    waiter = _get_result_waiter(session.bind)
+    ready = waiter.register(task_id)
+    deadline = time.monotonic() + timeout
+    try:
+        session.bind.execute(
+            RestfulpyTask.__table__.update()
+            .where(RestfulpyTask.id == task_id)
+            .where(RestfulpyTask.has_waiters.is_(False))
+            .values(has_waiters=True)
+        )
+        while True:
+            ready.clear()
+            status = session.query(RestfulpyTask.status) \
+                .filter(RestfulpyTask.id == task_id) \
+                .scalar()
+            if status in FINISHED_STATUSES:
+                return session.query(RestfulpyTask) \
+                    .populate_existing() \
+                    .get(task_id)
+
+            remaining = deadline - time.monotonic()
+            if status is None or remaining <= 0:
+                return None
+
+            ready.wait(remaining)
+    finally:
+        waiter.unregister(task_id, ready)
+
+
+def get_worker_prefix(pid=None):
+    """Returns the common prefix of the worker ids of a process."""
+    return '%s:%s:' % (socket.gethostname(), pid or os.getpid())
+
+
+def create_worker_id():
+    return '%s%s' % (get_worker_prefix(), threading.get_ident())
+
+
+class Heartbeat(threading.Thread):
+    """Periodically extends the leases of the tasks held by a worker.
+
+    The leases are renewed at one third of their length, so a worker
+    survives a couple of missed beats before its tasks get reclaimed.
+    """
+
+    def __init__(self, engine, worker_id, lease=None):
+        super().__init__(name='restfulpy-heartbeat', daemon=True)
+        self.engine = engine
+        self.worker_id = worker_id
+        self.lease = lease or settings.worker.lease
+        self.stopped = threading.Event()
+
+    def beat(self):
+        table = RestfulpyTask.__table__
+        with self.engine.begin() as connection:
+            connection.execute(
+                table.update()
+                .where(table.c.worker_id == self.worker_id)
+                .where(table.c.status == 'in-progress')
+                .values(
+                    leased_until=func.timezone('utc', func.now())
+                    + timedelta(seconds=self.lease)
+                )
+            )
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                self.beat()
+            except:
+                logger.error(
+                    'Cannot renew the leases of worker: %s' % self.worker_id
+                )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Watchdog(threading.Thread):
+    """Enforces the ``__timeout__`` of the tasks executed by the threads.
+
+    The ``cancelled`` event of an overdue task is set, then a
+    :class:`TaskTimeoutError` is raised asynchronously in its thread, which
+    interrupts the Python code but not a blocking system call. A task which
+    is still stuck after the ``settings.worker.timeout_grace`` is recorded
+    as ``timed-out`` and, if :attr:`exit_on_stuck` is set, i.e: in the
+    forked worker processes, the process is killed to be restarted by the
+    supervisor. Otherwise it is just logged.
+    """
+
+    def __init__(self, interval=.1):
+        super().__init__(name='restfulpy-watchdog', daemon=True)
+        self.interval = interval
+        self.exit_on_stuck = False
+        self.lock = threading.Lock()
+        self.started = False
+
+        # Thread ident: [task, deadline, cancelled at]
+        self.watches = {}
+
+    @contextmanager
+    def watch(self, task):
+        task.cancelled = threading.Event()
+        if not task.__timeout__:
+            yield
+            return
+
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.start()
+
+            ident = threading.get_ident()
+            self.watches[ident] = \
+                [task, time.monotonic() + task.__timeout__, None]
 
-    while True:
-        context['counter'] += 1
-        logger.debug('Trying to pop a task, Counter: %s' % context['counter'])
         try:
-            task = RestfulpyTask.pop(
+            yield
+        finally:
+            # The pending exception might be raised right here, before the
+            # watch is removed.
+            try:
+                self.unwatch(ident)
+            except TaskTimeoutError:
+                self.unwatch(ident)
+                raise
+
+    def unwatch(self, ident):
+        """Stops watching the thread, the timeout exception which is not
+        raised yet is cancelled, so it could not hit the code running after
+        the task.
+        """
+        with self.lock:
+            watch = self.watches.pop(ident, None)
+            if watch is not None and watch[2] is not None:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_ulong(ident),
+                    None
+                )
+
+    def check(self):
+        now = time.monotonic()
+        stuck = []
+        with self.lock:
+            for ident, watch in self.watches.items():
+                task, deadline, cancelled_at = watch
+                if now < deadline:
+                    continue
+
+                if cancelled_at is None:
+                    watch[2] = now
+                    task.cancelled.set()
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(ident),
+                        ctypes.py_object(TaskTimeoutError)
+                    )
+
+                elif now - cancelled_at > settings.worker.timeout_grace:
+                    # Reporting once
+                    watch[2] = float('inf')
+                    stuck.append(task)
+
+        for task in stuck:
+            self.abandon(task)
+
+    def abandon(self, task):
+        logger.error('Task is stuck after its timeout: %s' % task.id)
+        if not self.exit_on_stuck:
+            return
+
+        session = create_thread_unsafe_session()
+        try:
+            reason = f'Killed after the timeout of {task.__timeout__} seconds'
+            session.query(RestfulpyTask) \
+                .filter(RestfulpyTask.id == task.id) \
+                .filter(RestfulpyTask.status == 'in-progress') \
+                .filter(RestfulpyTask.worker_id == task.worker_id) \
+                .update(
+                    task.get_failure_values(reason, timed_out=True),
+                    synchronize_session=False
+                )
+            session.commit()
+        finally:
+            session.close()
+            sys.stderr.flush()
+            os._exit(1)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except:
+                logger.error('Error when checking the task timeouts')
+
+
+class TaskThrottle:
+    """Enforces the ``__max_concurrency__`` and ``__rate_limit__`` of the
+    task types among the workers of a process.
+
+    The task types which are out of budget are excluded from the claim query
+    and the others are claimed up to their remaining budget, so a throttled
+    task is never popped just to wait. The rate limit is a token bucket
+    holding up to one second worth of tasks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.buckets = {}
+
+    @staticmethod
+    def iter_limited_types():
+        for name, mapper in RestfulpyTask.__mapper__.polymorphic_map.items():
+            class_ = mapper.class_
+            if class_.__max_concurrency__ is not None \
+                    or class_.__rate_limit__ is not None:
+                yield name, class_
+
+    def _refill(self, name, rate, now):
+        capacity = max(rate, 1)
+        tokens, last = self.buckets.get(name, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+        self.buckets[name] = (tokens, now)
+        return tokens
+
+    def _reserve(self, name, class_, count):
+        self.running[name] = self.running.get(name, 0) + count
+        if class_.__rate_limit__ is not None:
+            tokens, last = self.buckets[name]
+            self.buckets[name] = (tokens - count, last)
+
+    def get_allowances(self):
+        """Returns the number of tasks could be claimed right now for each
+        limited task type.
+        """
+        now = time.monotonic()
+        allowances = {}
+        for name, class_ in self.iter_limited_types():
+            allowance = None
+            if class_.__max_concurrency__ is not None:
+                allowance = \
+                    class_.__max_concurrency__ - self.running.get(name, 0)
+
+            if class_.__rate_limit__ is not None:
+                tokens = int(self._refill(name, class_.__rate_limit__, now))
+                allowance = tokens if allowance is None \
+                    else min(allowance, tokens)
+
+            allowances[name] = max(allowance, 0)
+
+        return allowances
+
+    def pop_many(self, count, statuses={'new'}, filters=None,
+                 session=DBSession, worker_id=None):
+        with self.lock:
+            allowances = self.get_allowances()
+            excluded = [k for k, v in allowances.items() if not v]
+            available = {k: min(v, count) for k, v in allowances.items() if v}
+
+            # Reserving the budget beforehand to not hold the lock while
+            # querying, the unused part is given back afterwards.
+            limited = dict(self.iter_limited_types())
+            for name, limit in available.items():
+                self._reserve(name, limited[name], limit)
+
+        claimed = {}
+        try:
+            tasks = RestfulpyTask.pop_many(
+                count,
                 statuses=statuses,
                 filters=filters,
-                session=isolated_session
+                session=session,
+                worker_id=worker_id,
+                excluded_types=excluded,
+                type_limits=available
+            )
+            for task in tasks:
+                claimed[task.type] = claimed.get(task.type, 0) + 1
+
+            return tasks
+
+        finally:
+            with self.lock:
+                for name, limit in available.items():
+                    self._reserve(
+                        name,
+                        limited[name],
+                        claimed.get(name, 0) - limit
+                    )
+
+    def release(self, task):
+        """Should be called when the execution of a claimed task is
+        finished.
+        """
+        with self.lock:
+            if task.type in self.running:
+                self.running[task.type] -= 1
+
+
+throttle = TaskThrottle()
+metrics = WorkerMetrics()
+watchdog = Watchdog()
+
+# Only the last results are kept, a long running worker would leak otherwise
+MAX_RESULTS = 1000
+
+
+def _execute(task, context):
+    with watchdog.watch(task):
+        return task.execute(context)
+
+
+def _get_storable_result(task, result):
+    """Returns the `result` if it could be stored as JSON, otherwise
+    :data:`None`. The side effects of the task are committed already, so
+    the task is succeeded anyway.
+    """
+    try:
+        json.dumps(result)
+    except (TypeError, ValueError):
+        logger.error(
+            'The result of the task %s is not JSON serializable: %s'
+            % (task.id, type(result).__name__)
+        )
+        return None
+
+    return result
+
+
+def _is_terminal(values):
+    return values['status'] == 'failed'
+
+
+def worker(statuses={'new'}, filters=None, tries=-1, batch_size=None,
+           listen=None, stop=None):
+    # Claimed tasks are fully loaded, expiring them on each commit would
+    # cost a query per task.
+    isolated_session = create_thread_unsafe_session(expire_on_commit=False)
+    context = {'counter': 0}
+    tasks = deque(maxlen=MAX_RESULTS)
+    batch_size = batch_size or settings.worker.batch_size
+    if listen is None:
+        listen = settings.worker.listen
+
+    # Listening before the first pop, so no notification could be missed
+    listener = TaskListener(isolated_session.bind) if listen else None
+
+    worker_id = create_worker_id()
+    heartbeat = None
+    if settings.worker.lease:
+        heartbeat = Heartbeat(isolated_session.bind, worker_id)
+        heartbeat.start()
+
+    metrics.worker_started()
+    try:
+        # The stop event lets the worker drain: the claimed batch is
+        # finished before returning.
+        while stop is None or not stop.is_set():
+            context['counter'] += 1
+            logger.debug(
+                'Trying to pop a task, Counter: %s' % context['counter']
             )
-            assert task is not None
+            try:
+                batch = throttle.pop_many(
+                    batch_size,
+                    statuses=statuses,
+                    filters=filters,
+                    session=isolated_session,
+                    worker_id=worker_id
+                )
+                assert batch
+
+            except TaskPopError as ex:
+                logger.debug('No task to pop: %s' % ex.to_json())
+                isolated_session.rollback()
+                if tries > -1:
+                    tries -= 1
+                    if tries <= 0:
+                        break
+
+                if listener is not None:
+                    # The gap is only a fallback timeout here
+                    listener.wait(settings.worker.gap)
+                elif stop is not None:
+                    stop.wait(settings.worker.gap)
+                else:
+                    time.sleep(settings.worker.gap)
+                continue
+            except:
+                logger.error('Error when popping task.')
+                raise
 
+            for task in batch:
+                token = metrics.task_started(task)
+                task.started_at = datetime.utcnow()
+                try:
+                    result = _execute(task, context)
+
+                    # Task success
+                    task.status = 'success'
+                    task.result = _get_storable_result(task, result)
+                    task.terminated_at = datetime.utcnow()
+                    isolated_session.flush()
+                    if task.has_dependants:
+                        RestfulpyTask.release_dependants(
+                            [task.id],
+                            session=isolated_session
+                        )
+                    RestfulpyTask.notify_finished(
+                        [task.id],
+                        session=isolated_session
+                    )
+
+                except:
+                    logger.error('Error when executing task: %s' % task.id)
+                    fail_reason = traceback.format_exc()[-4096:]
+                    timed_out = isinstance(sys.exc_info()[1], TaskTimeoutError)
+
+                    # Discarding the changes made by the task itself
+                    isolated_session.rollback()
+                    task.fail(fail_reason, timed_out=timed_out)
+                    if task.next_attempt_at is None:
+                        isolated_session.flush()
+                        failed = RestfulpyTask.fail_dependants(
+                            [task.id],
+                            session=isolated_session
+                        ) if task.has_dependants else []
+                        RestfulpyTask.notify_finished(
+                            [task.id, *failed],
+                            session=isolated_session
+                        )
+
+                finally:
+                    if isolated_session.is_active:
+                        isolated_session.commit()
+                    throttle.release(task)
+                    metrics.task_finished(token, task.status)
+                    tasks.append((task.id, task.status))
+
+    finally:
+        metrics.worker_stopped()
+        if listener is not None:
+            listener.close()
+
+        if heartbeat is not None:
+            heartbeat.stop()
+
+    return list(tasks)
+
+
+def async_worker(statuses={'new'}, filters=None, tries=-1, concurrency=None,
+                 stop=None):
+    """Runs up to `concurrency` tasks at once on a private event loop.
+
+    Tasks defining ``async def do_`` are awaited on the loop, others are
+    executed in the loop's default thread pool. Claiming and completing rows
+    are done in batches on a dedicated database thread, so the coroutines
+    should not use the ``DBSession`` themselves.
+    """
+    isolated_session = create_thread_unsafe_session(expire_on_commit=False)
+    executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.new_event_loop()
+    worker_id = create_worker_id()
+    heartbeat = None
+    if settings.worker.lease:
+        heartbeat = Heartbeat(isolated_session.bind, worker_id)
+        heartbeat.start()
+
+    metrics.worker_started()
+    try:
+        return loop.run_until_complete(_async_work(
+            loop,
+            executor,
+            isolated_session,
+            worker_id,
+            statuses,
+            filters,
+            tries,
+            concurrency or settings.worker.concurrency,
+            stop
+        ))
+    finally:
+        metrics.worker_stopped()
+        if heartbeat is not None:
+            heartbeat.stop()
+
+        loop.close()
+        executor.shutdown()
+        isolated_session.close()
+
+
+async def _async_work(loop, executor, session, worker_id, statuses, filters,
+                      tries, concurrency, stop):
+    context = {'counter': 0}
+    tasks = deque(maxlen=MAX_RESULTS)
+    running = set()
+    finished = []
+    has_dependants = set()
+
+    async def claim(count):
+        try:
+            return await loop.run_in_executor(executor, partial(
+                throttle.pop_many,
+                count,
+                statuses=statuses,
+                filters=filters,
+                session=session,
+                worker_id=worker_id
+            ))
         except TaskPopError as ex:
             logger.debug('No task to pop: %s' % ex.to_json())
-            isolated_session.rollback()
-            if tries > -1:
-                tries -= 1
-                if tries <= 0:
-                    return tasks
-            time.sleep(settings.worker.gap)
-            continue
-        except:
-            logger.error('Error when popping task.')
-            raise
+            return []
 
+    def complete(mappings, parents):
         try:
-            task.execute(context)
+            complete_many(mappings, parents)
+        except Exception:
+            session.rollback()
+            logger.error('Error when completing the tasks, one by one now')
 
-            # Task success
-            task.status = 'success'
-            task.terminated_at = datetime.utcnow()
+            # The tasks failed to complete are reclaimed when their lease
+            # expires.
+            for m in mappings:
+                try:
+                    complete_many([m], parents)
+                except Exception:
+                    session.rollback()
+                    logger.error('Error when completing task: %s' % m['id'])
 
-        except:
+    def complete_many(mappings, parents):
+        session.bulk_update_mappings(RestfulpyTask, mappings)
+        succeeded = [m['id'] for m in mappings if m['status'] == 'success']
+        failed = [m['id'] for m in mappings if _is_terminal(m)]
+        RestfulpyTask.release_dependants(
+            [i for i in succeeded if i in parents],
+            session=session
+        )
+        failed.extend(RestfulpyTask.fail_dependants(
+            [i for i in failed if i in parents],
+            session=session
+        ))
+        RestfulpyTask.notify_finished(succeeded + failed, session=session)
+        session.commit()
+
+    async def flush():
+        if not finished:
+            return
+
+        mappings = finished[:]
+        finished.clear()
+        parents = {m['id'] for m in mappings} & has_dependants
+        has_dependants.difference_update(parents)
+        await loop.run_in_executor(executor, complete, mappings, parents)
+        tasks.extend((m['id'], m['status']) for m in mappings)
+
+    async def run(task):
+        token = metrics.task_started(task)
+        if task.has_dependants:
+            has_dependants.add(task.id)
+
+        values = dict(id=task.id, started_at=datetime.utcnow())
+        try:
+            if asyncio.iscoroutinefunction(task.do_):
+                result = await asyncio.wait_for(
+                    task.do_(context),
+                    task.__timeout__
+                )
+            else:
+                result = await loop.run_in_executor(
+                    None,
+                    _execute,
+                    task,
+                    context
+                )
+
+            values.update(
+                status='success',
+                result=_get_storable_result(task, result),
+                terminated_at=datetime.utcnow()
+            )
+
+        except Exception as ex:
             logger.error('Error when executing task: %s' % task.id)
-            task.status = 'failed'
-            task.fail_reason = traceback.format_exc()[-4096:]
+            values.update(task.get_failure_values(
+                traceback.format_exc()[-4096:],
+                timed_out=isinstance(
+                    ex,
+                    (asyncio.TimeoutError, TaskTimeoutError)
+                )
+            ))
 
         finally:
-            if isolated_session.is_active:
-                isolated_session.commit()
-            tasks.append((task.id, task.status))
+            finished.append(values)
+            throttle.release(task)
+            metrics.task_finished(token, values.get('status', 'failed'))
+
+    while stop is None or not stop.is_set():
+        await flush()
+        context['counter'] += 1
+        batch = []
+        if len(running) < concurrency:
+            batch = await claim(concurrency - len(running))
+            running.update(loop.create_task(run(t)) for t in batch)
+
+            # Trying to fill the free slots before waiting
+            if batch and len(running) < concurrency:
+                continue
+
+        if running:
+            _, running = await asyncio.wait(
+                running,
+                timeout=settings.worker.gap,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            continue
+
+        if tries > -1:
+            tries -= 1
+            if tries <= 0:
+                break
+
+        await asyncio.sleep(settings.worker.gap)
+
+    # Draining
+    if running:
+        await asyncio.wait(running)
 
+    await flush()
+    return list(tasks)
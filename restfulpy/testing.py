@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import uuid
 from os import path
 
@@ -16,6 +17,13 @@ from .orm import setup_schema, session_factory, create_engine, init_model, \
     DBSession
 
 
+def _stop_result_waiter():
+    # Only if the task queue is in use, importing it would add its tables
+    taskqueue = sys.modules.get('restfulpy.taskqueue')
+    if taskqueue is not None:
+        taskqueue.stop_result_waiter()
+
+
 LEGEND = '''
 
 ### Legend
@@ -108,6 +116,9 @@ def db():
 
     yield _connect
 
+    # The listening connection of the waiters holds the database
+    _stop_result_waiter()
+
     # Closing all sessions created by the test writer
     for s in sessions:
         s.close()
@@ -198,6 +209,9 @@ class ApplicableTestCase:
 
     @classmethod
     def cleanup_orm(cls):
+        # The listening connection of the waiters holds the database
+        _stop_result_waiter()
+
         # Closing all sessions created by the test writer
         while True:
             try:
@@ -0,0 +1 @@
+b = 123
@@ -16,7 +16,7 @@ def test_appcli_root():
 
 EXPECTED_HELP = '''\
 usage: foo [-h] [-p PREFIX] [-c FILE]
-           {configuration,db,jwt,migrate,worker,completion} ...
+           {configuration,db,jwt,migrate,scheduler,worker,completion} ...
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -26,11 +26,12 @@ optional arguments:
                         Configuration file, Default: none
 
 Sub commands:
-  {configuration,db,jwt,migrate,worker,completion}
+  {configuration,db,jwt,migrate,scheduler,worker,completion}
     configuration       Configuration tools
     db                  Database administrationn
     jwt                 JWT management
     migrate             Executes the alembic command
+    scheduler           Recurring jobs administration
     worker              Task queue administration
     completion          Bash auto completion using argcomplete python package.
 '''
@@ -17,7 +17,7 @@ class WorkerTask(RestfulpyTask):
     }
 
     def do_(self, context):
-        _task_done.set()
+        pass
 
 
 class FooApplication(RestfulpyApplication):
@@ -56,6 +56,23 @@ def test_appcli_worker_start(db):
         assert status == -15
 
 
+def test_appcli_worker_start_processes(db):
+    session = db()
+    task = WorkerTask()
+    session.add(task)
+    session.commit()
+
+    with Given(app, 'worker start --processes 2 --number-of-threads 2',
+               nowait=True):
+        time.sleep(3)
+        story.kill()
+        story.wait()
+        assert stderr == ''
+
+    session.refresh(task)
+    assert task.status == 'success'
+
+
 if __name__ == '__main__':  # pragma: no cover
     foo.cli_main(['migrate', '--help'])
 
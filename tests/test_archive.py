@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+from restfulpy.archive import archive_tasks, archived_task_table, \
+    ArchiveTask, register_archive_job
+from restfulpy.messaging import Email
+from restfulpy.scheduler import iter_recurring_task_types
+from restfulpy.taskqueue import RestfulpyTask
+
+
+class ArchivableTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'archivable_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def test_archive_tasks(db):
+    session = db()
+    old = datetime.utcnow() - timedelta(days=10)
+    for status in ('new', 'in-progress', 'success', 'failed', 'retrying'):
+        session.add(ArchivableTask(status=status, created_at=old))
+
+    session.add(ArchivableTask(status='success'))
+    session.add(Email(
+        to='foo@example.com',
+        subject='Foo',
+        body='Bar',
+        status='success',
+        created_at=old
+    ))
+    session.commit()
+
+    assert archive_tasks(days=5, session=session, batch_size=2) == 3
+    assert session.query(RestfulpyTask).count() == 4
+    assert session.query(Email).count() == 0
+
+    rows = session.execute(
+        archived_task_table.select().order_by(archived_task_table.c.id)
+    ).fetchall()
+    assert [r.status for r in rows] == ['success', 'failed', 'success']
+    assert rows[0].data is None
+    assert rows[2].type == 'email'
+    assert rows[2].data['to'] == 'foo@example.com'
+    assert rows[2].archived_at is not None
+
+    # Nothing more to archive
+    assert archive_tasks(days=5, session=session) == 0
+
+
+def test_archive_task(db):
+    session = db()
+    session.add(ArchivableTask(
+        status='success',
+        created_at=datetime.utcnow() - timedelta(days=40)
+    ))
+    session.commit()
+
+    ArchiveTask().do_({})
+    assert session.query(RestfulpyTask).count() == 0
+
+
+def test_register_archive_job():
+    assert 'restfulpy_archive' not in dict(iter_recurring_task_types())
+
+    register_archive_job('0 0 * * *')
+    try:
+        assert dict(iter_recurring_task_types())['restfulpy_archive'] \
+            is ArchiveTask
+        assert ArchiveTask.__cron__ == '0 0 * * *'
+
+    finally:
+        ArchiveTask.__cron__ = None
@@ -0,0 +1,54 @@
+from restfulpy.autoscaler import Autoscaler
+from restfulpy.taskqueue import RestfulpyTask, get_worker_prefix, \
+    create_worker_id
+
+
+class ScaledTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'scaled_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def test_decide():
+    autoscaler = Autoscaler(2, 10, slots=2, cooldown=2)
+
+    # Under the minimum
+    assert autoscaler.decide(0, 0, 0) == 2
+
+    # Busy with a backlog, doubled at most
+    assert autoscaler.decide(2, 100, 4) == 4
+    assert autoscaler.decide(4, 3, 8) == 6
+    assert autoscaler.decide(8, 100, 16) == 10
+    assert autoscaler.decide(10, 100, 20) == 10
+
+    # Some slots are idle meanwhile
+    assert autoscaler.decide(4, 3, 2) == 4
+
+    # Shrinking after the cooldown
+    assert autoscaler.decide(4, 0, 1) == 4
+    assert autoscaler.decide(4, 0, 1) == 3
+    assert autoscaler.decide(3, 0, 0) == 3
+    assert autoscaler.decide(3, 1, 6) == 4
+    assert autoscaler.decide(4, 0, 0) == 4
+    assert autoscaler.decide(4, 0, 0) == 3
+    assert autoscaler.decide(2, 0, 0) == 2
+    assert autoscaler.decide(2, 0, 0) == 2
+
+
+def test_sample(db):
+    session = db()
+    for i in range(5):
+        session.add(ScaledTask())
+    session.commit()
+
+    autoscaler = Autoscaler(1, 2, slots=1)
+    assert autoscaler.sample([get_worker_prefix()]) == (2, 0)
+
+    RestfulpyTask.pop_many(3, session=session, worker_id=create_worker_id())
+    RestfulpyTask.pop(session=session, worker_id='another-host:1:1')
+    assert autoscaler.sample([get_worker_prefix()]) == (1, 3)
+    assert autoscaler.sample([]) == (1, 0)
@@ -1,5 +1,9 @@
+from datetime import datetime, date
+from decimal import Decimal
+
 from bddrest import response, when, Update, status
-from nanohttp import json
+from nanohttp import json, action
+from nanohttp.contexts import Context
 from sqlalchemy import Unicode, Integer, Date, Float, ForeignKey, Boolean, \
     DateTime
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -8,6 +12,7 @@ from restfulpy.controllers import JSONPatchControllerMixin, ModelRestController
 from restfulpy.orm import commit, DeclarativeBase, Field, DBSession, \
     composite, FilteringMixin, PaginationMixin, OrderingMixin, relationship, \
     ModifiedMixin, ActivationMixin, synonym
+from restfulpy.orm.models import create_exporter
 from restfulpy.testing import ApplicableTestCase
 
 
@@ -163,6 +168,18 @@ class Member(ActivationMixin, ModifiedMixin, FilteringMixin, PaginationMixin,
     )
 
 
+class Badge(DeclarativeBase):
+    __tablename__ = 'badge'
+
+    id = Field(Integer, primary_key=True)
+    title = Field(Unicode(50))
+
+    def to_dict(self):
+        result = super().to_dict()
+        result['label'] = self.title.capitalize()
+        return result
+
+
 class Root(JSONPatchControllerMixin, ModelRestController):
     __model__ = Member
 
@@ -183,6 +200,11 @@ class Root(JSONPatchControllerMixin, ModelRestController):
             return query.filter(Member.title == title).one_or_none()
         return query
 
+    @action(content_type='application/json')
+    @Member.expose(stream=True)
+    def export(self):
+        return DBSession.query(Member)
+
     @json
     @Member.expose
     def me(self):
@@ -253,6 +275,66 @@ class TestBaseModel(ApplicableTestCase):
             when('Getting a plain dictionary', '/me')
             assert response.json == {'title': 'me'}
 
+    def test_fields(self):
+        with self.given(
+                'Getting only a few fields',
+                query=dict(fields='title,firstName,fullName')
+            ):
+            assert status == 200
+            assert len(response.json) > 0
+            assert set(response.json[0]) == {'title', 'firstName', 'fullName'}
+
+            when(
+                'Streaming a few fields',
+                '/export',
+                query=dict(fields='title,firstName,fullName')
+            )
+            assert set(response.json[0]) == {'title', 'firstName', 'fullName'}
+
+            when('Requesting a protected field', query=dict(fields='password'))
+            assert status == 400
+
+            when('Requesting an invalid field', query=dict(fields='foo'))
+            assert status == 400
+
+    def test_fields_of_overridden_to_dict(self):
+        with Context({'QUERY_STRING': 'fields=title,label'}):
+            fields = Badge.get_fields_by_request()
+            assert fields == {'title', 'label'}
+            assert Badge.export_fields(Badge(title='gold'), fields) == \
+                {'title': 'gold', 'label': 'Gold'}
+
+    def test_load_only_option(self):
+        option = Member.create_load_only_option({'title', 'avatarImage'})
+        statement = str(DBSession.query(Member).options(option).statement)
+        columns = statement.split('\nFROM ')[0][len('SELECT '):].split(', ')
+        assert sorted(c.strip() for c in columns) == \
+            ['member.avatar', 'member.id', 'member.title']
+
+        # Hybrid properties are not backed by any column
+        assert Member.create_load_only_option({'isActive'}) is None
+
+    def test_stream(self):
+        with self.given(
+                'Streaming the objects',
+                '/export',
+                query=dict(sort='id')
+            ):
+            assert status == 200
+            assert response.content_type == 'application/json'
+            streamed = response.json
+            assert len(streamed) > 0
+
+            when('Getting the same objects at once', '/')
+            assert streamed == response.json
+
+            when(
+                'Filtering out all of the objects',
+                '/export',
+                query=dict(title='non-existence')
+            )
+            assert response.json == []
+
     def test_iter_columns(self):
         columns = {
             c.key: c for c in Member.iter_columns(
@@ -321,3 +403,41 @@ class TestBaseModel(ApplicableTestCase):
                 'The phone number cannot contain alphabet'
             assert fields['password']['label'] == 'Password'
 
+    def test_export_plan(self):
+        plan = Member.get_export_plan()
+        assert plan is Member.get_export_plan()
+
+        names = [name for _, name, _ in plan]
+        assert len(names) == len(set(names))
+        assert 'password' not in names
+        assert 'avatarImage' in names
+        assert 'fullName' in names
+        assert 'Keywords' in names
+
+    def test_json_index(self):
+        index = Member.get_json_index()
+        assert index is Member.get_json_index()
+
+        # Both of the column and its synonym
+        assert {c.column.key for c in index['password']} == \
+            {'_password', 'password'}
+        assert all(c.protected for c in index['password'])
+        assert index['birth'][0].parse is not None
+        assert index['fullName'][0].readonly
+        assert index['books'][0].relationship
+        assert 'avatar' not in index
+
+    def test_create_exporter(self):
+        export = create_exporter(Member.birth)
+        assert export(None) is None
+        assert export(date(2001, 1, 1)) == '2001-01-01'
+
+        export = create_exporter(Member.last_login_time)
+        assert export(datetime(2001, 1, 1, 1, 1, 1)).startswith(
+            '2001-01-01T01:01:01'
+        )
+
+        # Falls back to the generic conversion for the other types
+        assert export(date(2001, 1, 1)) == '2001-01-01'
+        assert create_exporter(Member.weight)(Decimal('1.1')) == '1.1'
+        assert create_exporter(Member.title)('foo') == 'foo'
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from urllib.request import urlopen
+
+from restfulpy.metrics import Histogram, WorkerMetrics, MetricsServer
+from restfulpy.taskqueue import RestfulpyTask, worker, metrics
+
+
+class MeasuredTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'measured_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(1, 2, float('inf')))
+    for value in (.5, 1, 1.5, 10):
+        histogram.observe(value)
+
+    assert list(histogram.render('foo', 'type="bar"')) == [
+        'foo_bucket{type="bar",le="1"} 2',
+        'foo_bucket{type="bar",le="2"} 3',
+        'foo_bucket{type="bar",le="+Inf"} 4',
+        'foo_sum{type="bar"} 13.0',
+        'foo_count{type="bar"} 4',
+    ]
+
+
+def test_worker_metrics(db):
+    session = db()
+    task = MeasuredTask()
+    session.add(task)
+    session.commit()
+
+    worker_metrics = WorkerMetrics()
+    worker_metrics.worker_started()
+    token = worker_metrics.task_started(task)
+    assert worker_metrics.busy_threads == 1
+    worker_metrics.task_finished(token, 'success')
+    assert worker_metrics.busy_threads == 0
+
+    text = worker_metrics.render({('new', 50): 3})
+    assert 'restfulpy_tasks_total{type="measured_task",status="success"} 1' \
+        in text
+    assert 'restfulpy_task_run_seconds_count{type="measured_task"} 1' in text
+    assert 'restfulpy_task_queue_wait_seconds_count{type="measured_task"} 1' \
+        in text
+    assert 'restfulpy_worker_threads 1' in text
+    assert 'restfulpy_queue_depth{status="new",priority="50"} 3' in text
+
+    # A retry waits since its next attempt is due, not since its creation
+    retried = MeasuredTask(
+        status='retrying',
+        created_at=datetime.utcnow() - timedelta(hours=1),
+        next_attempt_at=datetime.utcnow()
+    )
+    token = worker_metrics.task_started(retried)
+    worker_metrics.task_finished(token, 'success')
+    assert worker_metrics.queue_wait['measured_task'].sum < 60
+
+
+def test_queue_depth_and_server(db):
+    session = db()
+    session.add(MeasuredTask(priority=10))
+    session.add(MeasuredTask(priority=10))
+    session.add(MeasuredTask(priority=20, status='failed'))
+    session.add(MeasuredTask(status='success'))
+    session.commit()
+
+    assert RestfulpyTask.get_queue_depth(session) == {
+        ('new', 10): 2,
+        ('failed', 20): 1,
+    }
+
+    worker(tries=0)
+    assert metrics.counters[('measured_task', 'success')] >= 2
+
+    server = MetricsServer(
+        metrics,
+        0,
+        host='localhost',
+        queue_depth=lambda: RestfulpyTask.get_queue_depth(session)
+    )
+    server.start()
+    try:
+        with urlopen(f'http://localhost:{server.port}/metrics') as response:
+            assert response.status == 200
+            text = response.read().decode()
+    finally:
+        server.stop()
+
+    assert 'restfulpy_queue_depth{status="failed",priority="20"} 1' in text
+    assert 'restfulpy_tasks_total{type="measured_task",status="success"}' \
+        in text
@@ -3,7 +3,8 @@ from nanohttp import HTTPBadRequest
 from nanohttp.contexts import Context
 from sqlalchemy import Integer, Unicode
 
-from restfulpy.orm import DeclarativeBase, Field, PaginationMixin
+from restfulpy.orm import DeclarativeBase, Field, PaginationMixin, \
+    OrderingMixin
 
 
 class PagingObject(PaginationMixin, DeclarativeBase):
@@ -14,6 +15,15 @@ class PagingObject(PaginationMixin, DeclarativeBase):
     title = Field(Unicode(50))
 
 
+class KeysetObject(PaginationMixin, OrderingMixin, DeclarativeBase):
+    __tablename__ = 'keyset_object'
+    __max_take__ = 4
+    __keyset_pagination__ = True
+
+    id = Field(Integer, primary_key=True)
+    score = Field(Integer, nullable=True)
+
+
 def test_pagination_mixin(db):
     session = db()
 
@@ -39,3 +49,123 @@ def test_pagination_mixin(db):
     with Context({'QUERY_STRING': 'take=5'}), pytest.raises(HTTPBadRequest):
         PagingObject.paginate_by_request(query)
 
+
+def test_keyset_pagination(db):
+    session = db()
+    for score in (None, 10, 20, 20, None):
+        session.add(KeysetObject(score=score))
+    session.commit()
+
+    query = session.query(KeysetObject)
+
+    def iter_pages(sort):
+        cursor = None
+        while True:
+            query_string = f'take=2&sort={sort}'
+            if cursor:
+                query_string += f'&after={cursor}'
+
+            with Context({'QUERY_STRING': query_string}) as context:
+                query_ = KeysetObject.sort_by_request(query)
+                yield [
+                    o.id for o in KeysetObject.iter_paginated(
+                        KeysetObject.paginate_by_request(query_)
+                    )
+                ]
+                assert context.response_headers['X-Pagination-Count'] == '5'
+                cursor = context.response_headers.get('X-Pagination-Cursor')
+                if cursor is None:
+                    return
+
+    assert list(iter_pages('id')) == [[1, 2], [3, 4], [5]]
+
+    # The rows are the objects only
+    with Context({'QUERY_STRING': 'take=2'}):
+        assert all(
+            isinstance(o, KeysetObject)
+            for o in KeysetObject.paginate_by_request(query)
+        )
+
+    # Nulls first when descending, the ties are ordered by the primary key
+    assert list(iter_pages('-score')) == [[1, 5], [3, 4], [2]]
+    assert list(iter_pages('score')) == [[2, 3], [4, 1], [5]]
+
+    # A row comparison when none of the keys is nullable
+    criteria = KeysetObject._create_keyset_criteria(
+        [(KeysetObject.id, True)],
+        [3]
+    )
+    assert str(criteria) == '(keyset_object.id) < (:param_1)'
+
+    with Context({'QUERY_STRING': 'sort=id'}) as context:
+        list(KeysetObject.iter_paginated(
+            KeysetObject.paginate_by_request(query)
+        ))
+        cursor = context.response_headers['X-Pagination-Cursor']
+
+    # The cursor of the other orders
+    with Context({'QUERY_STRING': f'sort=-id&after={cursor}'}), \
+            pytest.raises(HTTPBadRequest):
+        KeysetObject.paginate_by_request(query)
+
+    with Context({'QUERY_STRING': 'after=invalid'}), \
+            pytest.raises(HTTPBadRequest):
+        KeysetObject.paginate_by_request(query)
+
+
+def test_count_strategies(db):
+    session = db()
+    for i in range(1, 6):
+        session.add(PagingObject(title=f'object {i}'))
+    session.commit()
+
+    query = session.query(PagingObject).order_by(PagingObject.id)
+
+    def paginate(strategy, query_string='take=2'):
+        PagingObject.__count_strategy__ = strategy
+        try:
+            with Context({'QUERY_STRING': query_string}) as context:
+                ids = [
+                    o.id for o in PagingObject.iter_paginated(
+                        PagingObject.paginate_by_request(query)
+                    )
+                ]
+                headers = context.response_headers
+                assert headers['X-Pagination-Count-Strategy'] == strategy
+                return ids, headers.get('X-Pagination-Count')
+        finally:
+            del PagingObject.__count_strategy__
+
+    assert paginate('exact') == ([1, 2], '5')
+    assert paginate('window') == ([1, 2], '5')
+
+    # The window count does not change the rows
+    PagingObject.__count_strategy__ = 'window'
+    try:
+        with Context({'QUERY_STRING': 'take=2'}):
+            assert all(
+                isinstance(o, PagingObject)
+                for o in PagingObject.paginate_by_request(query)
+            )
+    finally:
+        del PagingObject.__count_strategy__
+
+    # The cursor is ignored unless the keyset pagination is enabled
+    assert paginate('exact', 'take=2&after=invalid') == ([1, 2], '5')
+
+    # Beyond the last page
+    assert paginate('window', 'take=2&skip=6') == ([], '5')
+    assert paginate('none') == ([1, 2], None)
+
+    ids, count = paginate('estimated')
+    assert ids == [1, 2]
+    assert int(count) >= 0
+
+    assert paginate('cached') == ([1, 2], '5')
+    session.add(PagingObject(title='object 6'))
+    session.commit()
+    assert paginate('cached') == ([1, 2], '5')
+    assert paginate('exact') == ([1, 2], '6')
+
+    with pytest.raises(ValueError):
+        paginate('invalid')
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from restfulpy.scheduler import Cron, ScheduledJob, schedule
+from restfulpy.taskqueue import RestfulpyTask, TaskPopError
+
+
+class RecurringTask(RestfulpyTask):
+    __cron__ = '*/15 * * * *'
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'recurring_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def test_cron():
+    after = datetime(2020, 1, 31, 23, 59, 30)
+    assert Cron('* * * * *').next(after) == datetime(2020, 2, 1, 0, 0)
+    assert Cron('*/15 * * * *').next(datetime(2020, 1, 1, 0, 0)) == \
+        datetime(2020, 1, 1, 0, 15)
+    assert Cron('30 8 * * 1-5').next(after) == datetime(2020, 2, 3, 8, 30)
+    assert Cron('0 0 29 2 *').next(after) == datetime(2020, 2, 29, 0, 0)
+    assert Cron('0 0 * * 7').next(after) == datetime(2020, 2, 2, 0, 0)
+
+    # Either the day of month or the day of week
+    assert Cron('0 12 13 * 5').next(after) == datetime(2020, 2, 7, 12, 0)
+
+    with pytest.raises(ValueError):
+        Cron('* * * *')
+
+    with pytest.raises(ValueError):
+        Cron('60 * * * *')
+
+    with pytest.raises(ValueError):
+        Cron('0 0 30 2 *').next(after)
+
+
+def test_schedule(db):
+    session = db()
+    now = datetime(2020, 1, 1, 0, 5)
+
+    # The first time, just registering the job
+    assert schedule(session, now=now) == 0
+    job = session.query(ScheduledJob).one()
+    assert job.next_run_at == datetime(2020, 1, 1, 0, 15)
+
+    assert schedule(session, now=now + timedelta(minutes=10)) == 1
+    session.refresh(job)
+    assert job.next_run_at == datetime(2020, 1, 1, 0, 30)
+    task = session.query(RecurringTask).one()
+    assert task.run_at == datetime(2020, 1, 1, 0, 15)
+
+    # Missed runs are coalesced
+    assert schedule(session, now=now + timedelta(hours=1)) == 1
+    session.refresh(job)
+    assert job.next_run_at == datetime(2020, 1, 1, 1, 15)
+    assert session.query(RecurringTask).count() == 2
+
+
+def test_pop_skips_future_tasks(db):
+    session = db()
+    session.add(RecurringTask(run_at=datetime.utcnow() + timedelta(hours=1)))
+    session.commit()
+
+    with pytest.raises(TaskPopError):
+        RestfulpyTask.pop(session=session)
+
+    task = session.query(RecurringTask).one()
+    task.run_at = datetime.utcnow() - timedelta(seconds=1)
+    session.commit()
+    assert RestfulpyTask.pop(session=session).id == task.id
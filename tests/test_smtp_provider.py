@@ -22,6 +22,7 @@ def test_smtp_provider():
           tls: false
           auth: false
           ssl: false
+          timeout: 10
         messaging:
           mako_modules_directory: {join(HERE, '../../data', 'mako_modules')}
           template_directories:
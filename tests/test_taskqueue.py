@@ -1,6 +1,16 @@
+import asyncio
 import threading
+import time
+from datetime import datetime, timedelta
 
-from restfulpy.taskqueue import RestfulpyTask, worker
+import pytest
+from nanohttp import settings
+from sqlalchemy import event, inspect
+
+from restfulpy.messaging import Email
+from restfulpy.taskqueue import RestfulpyTask, TaskPopError, TaskListener, \
+    worker, async_worker, Heartbeat, upgrade_schema, TaskThrottle, Workflow, \
+    wait, stop_result_waiter, _get_result_waiter, watchdog
 
 
 awesome_task_done = threading.Event()
@@ -37,6 +47,97 @@ class BadTask(RestfulpyTask):
         raise Exception()
 
 
+class AsyncTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'async_task'
+    }
+
+    async def do_(self, context):
+        await asyncio.sleep(.3)
+        if self.priority == 0:
+            raise Exception()
+
+
+class FlakyTask(RestfulpyTask):
+    __max_attempts__ = 3
+    __backoff__ = 60
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'flaky_task'
+    }
+
+    def do_(self, context):
+        raise Exception()
+
+
+class ResultTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'result_task'
+    }
+
+    def do_(self, context):
+        return {'answer': self.priority}
+
+
+class DatetimeResultTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'datetime_result_task'
+    }
+
+    def do_(self, context):
+        return datetime.utcnow()
+
+
+class HungTask(RestfulpyTask):
+    __timeout__ = .3
+    __max_attempts__ = 2
+    __backoff__ = 60
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'hung_task'
+    }
+
+    def do_(self, context):
+        while True:
+            time.sleep(.01)
+
+
+class HungAsyncTask(RestfulpyTask):
+    __timeout__ = .3
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'hung_async_task'
+    }
+
+    async def do_(self, context):
+        await asyncio.sleep(60)
+
+
+class ExclusiveTask(RestfulpyTask):
+    __max_concurrency__ = 1
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'exclusive_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+class RateLimitedTask(RestfulpyTask):
+    __rate_limit__ = 2
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'rate_limited_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
 def test_worker(db):
     session = db()
     awesome_task = AwesomeTask()
@@ -97,3 +198,554 @@ def test_worker(db):
     assert len(tasks) == 1
 
 
+def test_pop_many(db):
+    session = db()
+    for i in range(5):
+        session.add(AnotherTask(priority=i))
+    session.commit()
+
+    tasks = RestfulpyTask.pop_many(3, session=session)
+    assert len(tasks) == 3
+    assert [t.priority for t in tasks] == [4, 3, 2]
+    assert all(t.status == 'in-progress' for t in tasks)
+
+    tasks = RestfulpyTask.pop_many(3, session=session)
+    assert len(tasks) == 2
+
+    with pytest.raises(TaskPopError):
+        RestfulpyTask.pop_many(3, session=session)
+
+
+def test_pop_many_single_statement(db):
+    session = db()
+    session.add(AwesomeTask())
+    session.add(AnotherTask())
+    session.add(AnotherTask())
+    session.commit()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        statements.append(context.compiled)
+
+    event.listen(session.bind, 'before_cursor_execute', before_cursor_execute)
+    try:
+        tasks = RestfulpyTask.pop_many(2, session=session)
+        assert {type(t) for t in tasks} == {AwesomeTask, AnotherTask}
+        assert all(t.status == 'in-progress' for t in tasks)
+        assert len(statements) == 1
+
+        # Compiled once, the batch size is bound
+        RestfulpyTask.pop_many(1, session=session)
+        assert len(statements) == 2
+        assert statements[1] is statements[0]
+
+    finally:
+        event.remove(
+            session.bind,
+            'before_cursor_execute',
+            before_cursor_execute
+        )
+
+    session.expire_all()
+    assert all(t.status == 'in-progress' for t in tasks)
+
+
+def test_worker_batch(db):
+    session = db()
+    for i in range(5):
+        session.add(AnotherTask())
+    session.commit()
+
+    tasks = worker(tries=0, batch_size=2)
+    assert len(tasks) == 5
+    assert all(s == 'success' for _, s in tasks)
+
+
+def test_task_listener(db):
+    session = db()
+    listener = TaskListener(session.bind)
+    try:
+        assert not listener.wait(.1)
+
+        # Not announced unless the workers are listening
+        session.add(AnotherTask())
+        session.commit()
+        assert not listener.wait(.1)
+
+        settings.worker.listen = True
+        session.add(AnotherTask())
+        session.add(AwesomeTask())
+        session.commit()
+        assert listener.receive(1) == ['another_task,awesome_task']
+        assert not listener.wait(.1)
+
+    finally:
+        listener.close()
+
+    session.add(AnotherTask())
+    session.commit()
+    tasks = worker(tries=0, listen=True)
+    assert len(tasks) == 4
+
+
+def test_async_worker(db):
+    session = db()
+    for i in range(10):
+        session.add(AsyncTask(priority=i))
+    session.add(AnotherTask(priority=10))
+    session.commit()
+
+    tasks = async_worker(tries=0, concurrency=20)
+    assert len(tasks) == 11
+
+    statuses = dict(tasks)
+    failed = [i for i, s in statuses.items() if s == 'failed']
+    assert len(failed) == 1
+    assert session.query(RestfulpyTask) \
+        .filter(RestfulpyTask.status == 'success') \
+        .count() == 10
+
+
+def test_lease(db):
+    session = db()
+    task = AnotherTask()
+    session.add(task)
+    session.commit()
+
+    task = RestfulpyTask.pop(session=session, worker_id='foo')
+    assert task.worker_id == 'foo'
+    assert task.leased_until > datetime.utcnow()
+
+    # Healthy worker, nothing to reclaim
+    with pytest.raises(TaskPopError):
+        RestfulpyTask.pop(session=session, worker_id='bar')
+
+    # Lease is expired
+    task.leased_until = datetime.utcnow() - timedelta(minutes=1)
+    session.commit()
+
+    task = RestfulpyTask.pop(session=session, worker_id='bar')
+    assert task.worker_id == 'bar'
+
+    # Renewing
+    task.leased_until = datetime.utcnow() - timedelta(minutes=1)
+    session.commit()
+    Heartbeat(session.bind, 'bar').beat()
+    session.refresh(task)
+    assert task.leased_until > datetime.utcnow()
+    with pytest.raises(TaskPopError):
+        RestfulpyTask.pop(session=session, worker_id='baz')
+
+
+def test_retry(db):
+    session = db()
+    task = FlakyTask()
+    session.add(task)
+    session.commit()
+
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'flaky_task')
+    assert tasks == [(task.id, 'retrying')]
+    session.refresh(task)
+    assert task.attempts == 1
+    assert task.next_attempt_at - datetime.utcnow() > timedelta(seconds=50)
+
+    # Backing off
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'flaky_task')
+    assert tasks == []
+
+    for attempt in range(2, 4):
+        task.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        session.commit()
+        tasks = worker(tries=0, filters=RestfulpyTask.type == 'flaky_task')
+        assert len(tasks) == 1
+        session.refresh(task)
+        assert task.attempts == attempt
+
+    # Dead-letter
+    assert task.status == 'failed'
+    assert task.next_attempt_at is None
+
+    delays = [FlakyTask(attempts=i).get_retry_delay() for i in range(1, 4)]
+    assert 60 <= delays[0] <= 66
+    assert 120 <= delays[1] <= 132
+    assert 240 <= delays[2] <= 264
+
+
+def test_upgrade_schema(db):
+    session = db()
+    engine = session.bind
+    exhausted = AnotherTask(status='timed-out')
+    session.add(exhausted)
+    session.commit()
+    with engine.begin() as connection:
+        connection.execute('DROP INDEX restfulpy_task_new_idx')
+        connection.execute('DROP TABLE IF EXISTS restfulpy_job')
+        connection.execute(
+            'CREATE INDEX restfulpy_task_ready_idx ON restfulpy_task (id)'
+        )
+        connection.execute(
+            'ALTER TABLE restfulpy_task DROP COLUMN next_attempt_at'
+        )
+
+    upgrade_schema(engine)
+
+    # Idempotent
+    upgrade_schema(engine)
+
+    inspector = inspect(engine)
+    assert 'next_attempt_at' in \
+        {c['name'] for c in inspector.get_columns('restfulpy_task')}
+    indexes = {i['name'] for i in inspector.get_indexes('restfulpy_task')}
+    assert 'restfulpy_task_new_idx' in indexes
+    assert 'restfulpy_task_retry_idx' in indexes
+    assert 'restfulpy_task_ready_idx' not in indexes
+    assert 'restfulpy_job' in inspector.get_table_names()
+    session.refresh(exhausted)
+    assert exhausted.status == 'failed'
+
+
+def test_enqueue_many(db):
+    session = db()
+    tasks = [AnotherTask(priority=i) for i in range(5)]
+    tasks.insert(2, Email(to='foo@example.com', subject='Foo', body='Bar'))
+
+    ids = RestfulpyTask.enqueue_many(tasks, session=session, chunk_size=2)
+    session.commit()
+    assert len(ids) == 6
+    assert len(set(ids)) == 6
+
+    email = session.query(Email).one()
+    assert email.id == ids[2]
+    assert email.to == 'foo@example.com'
+    assert email.body == 'Bar'
+    assert email.from_ == 'restfulpy'
+    assert email.status == 'new'
+    assert email.created_at is not None
+
+    assert session.query(AnotherTask).count() == 5
+    assert [
+        session.query(AnotherTask).get(id_).priority
+        for id_ in ids[:2] + ids[3:]
+    ] == [0, 1, 2, 3, 4]
+
+    # Merged into the pending task having the same key
+    pending = AnotherTask(dedup_key='foo')
+    ids = RestfulpyTask.enqueue_many(
+        [AnotherTask(), pending, AnotherTask(dedup_key='foo'), AnotherTask()],
+        session=session
+    )
+    session.commit()
+    assert len(set(ids)) == 3
+    assert ids[1] == ids[2]
+    assert session.query(AnotherTask).get(ids[1]).dedup_key == 'foo'
+    assert RestfulpyTask.enqueue(
+        AnotherTask(dedup_key='foo'),
+        session=session
+    ) == ids[1]
+
+    tasks = RestfulpyTask.pop_many(10, session=session)
+    assert len(tasks) == 9
+
+
+def test_dedup_key(db):
+    session = db()
+    later = datetime.utcnow() + timedelta(hours=1)
+    ids = RestfulpyTask.enqueue_many([
+        AnotherTask(dedup_key='user:1', run_at=later),
+        AnotherTask(dedup_key='user:2'),
+        AnotherTask(dedup_key='user:1', priority=60, run_at=later),
+        AnotherTask(),
+    ], session=session)
+    session.commit()
+    assert ids[0] == ids[2]
+    assert len(set(ids)) == 3
+
+    # Merging into the pending task, bumping its priority
+    id_ = RestfulpyTask.enqueue(
+        AnotherTask(dedup_key='user:1', priority=70),
+        session=session
+    )
+    id_ = RestfulpyTask.enqueue(
+        AnotherTask(dedup_key='user:1', priority=10),
+        session=session
+    )
+    session.commit()
+    assert id_ == ids[0]
+    task = session.query(AnotherTask).get(id_)
+    assert task.priority == 70
+    assert task.run_at is None
+    assert session.query(AnotherTask).count() == 3
+
+    # A running task is not merged into
+    tasks = RestfulpyTask.pop_many(10, session=session)
+    assert tasks[0].id == id_
+    assert RestfulpyTask.enqueue(
+        AnotherTask(dedup_key='user:1'),
+        session=session
+    ) not in ids
+    session.commit()
+    assert session.query(AnotherTask).count() == 4
+
+    email_id = RestfulpyTask.enqueue(
+        Email(to='foo@example.com', subject='Foo', body='Bar', dedup_key='a'),
+        session=session
+    )
+    assert RestfulpyTask.enqueue(
+        Email(to='bar@example.com', subject='Foo', body='Bar', dedup_key='a'),
+        session=session
+    ) == email_id
+    session.commit()
+    assert session.query(Email).one().to == 'foo@example.com'
+
+
+def test_workflow(db):
+    session = db()
+    workflow = Workflow()
+    first = workflow.add(AnotherTask(priority=10))
+    children = [
+        workflow.add(AnotherTask(priority=i), depends_on=[first])
+        for i in range(3)
+    ]
+    join = workflow.add(AnotherTask(priority=100), depends_on=children)
+    bad = workflow.add(BadTask())
+    doomed = workflow.add(AnotherTask(), depends_on=[bad, first])
+    workflow.add(AnotherTask(), depends_on=[doomed])
+
+    with pytest.raises(ValueError):
+        workflow.add(AnotherTask(), depends_on=[AnotherTask()])
+
+    ids = workflow.enqueue(session=session)
+    session.commit()
+    session.expire_all()
+    join = session.query(RestfulpyTask).get(ids[4])
+    assert join.status == 'blocked'
+    assert join.pending_dependencies == 3
+    assert join.has_dependants is False
+    assert session.query(RestfulpyTask).get(ids[0]).has_dependants is True
+
+    # Only the first and the bad one are ready
+    tasks = worker(tries=0, batch_size=10)
+    assert sorted(tasks) == sorted([
+        (ids[0], 'success'),
+        (ids[5], 'failed'),
+        # Released in the same transaction, by the time of the next pop
+        (ids[1], 'success'),
+        (ids[2], 'success'),
+        (ids[3], 'success'),
+        (ids[4], 'success'),
+    ])
+
+    session.expire_all()
+    doomed = session.query(RestfulpyTask).get(ids[6])
+    assert doomed.status == 'failed'
+    assert doomed.fail_reason == 'A dependency is failed'
+    assert session.query(RestfulpyTask).get(ids[7]).status == 'failed'
+
+    # Releasing twice is harmless
+    assert RestfulpyTask.release_dependants([ids[0]], session=session) == []
+
+
+def test_workflow_dedup_key(db):
+    session = db()
+    workflow = Workflow()
+    first = workflow.add(AnotherTask(dedup_key='user:1'))
+    workflow.add(AnotherTask(dedup_key='user:1'), depends_on=[first])
+    ids = workflow.enqueue(session=session)
+    session.commit()
+    assert ids[0] != ids[1]
+
+    session.expire_all()
+    dependant = session.query(RestfulpyTask).get(ids[1])
+    assert dependant.status == 'blocked'
+    assert dependant.pending_dependencies == 1
+
+    # The dependant is not popped along with the root
+    tasks = RestfulpyTask.pop_many(10, session=session)
+    assert [t.id for t in tasks] == [ids[0]]
+
+
+def test_release_dedup_key(db):
+    session = db()
+    pending_id = RestfulpyTask.enqueue(
+        AnotherTask(dedup_key='user:1'),
+        session=session
+    )
+    ids = []
+    for key in ('user:1', 'user:2', 'user:2'):
+        workflow = Workflow()
+        first = workflow.add(AnotherTask())
+        workflow.add(AnotherTask(dedup_key=key), depends_on=[first])
+        ids.extend(workflow.enqueue(session=session))
+    session.commit()
+
+    # Colliding with the pending task and with each other
+    listener = TaskListener(session.bind)
+    try:
+        released = RestfulpyTask.release_dependants(
+            ids[::2],
+            session=session
+        )
+        session.commit()
+        assert sorted(released) == ids[1::2]
+
+        # The workers are woken up
+        assert listener.receive(1) == ['another_task']
+
+    finally:
+        listener.close()
+
+    session.expire_all()
+    keys = {
+        t.id: t.dedup_key for t in session.query(RestfulpyTask)
+        .filter(RestfulpyTask.id.in_([pending_id] + ids[1::2]))
+    }
+    assert keys == {
+        pending_id: 'user:1',
+        ids[1]: None,
+        ids[3]: 'user:2',
+        ids[5]: None,
+    }
+
+
+def test_wait(db):
+    session = db()
+    task = ResultTask(priority=42)
+    session.add(task)
+    session.commit()
+
+    # Not finished in time
+    assert wait(task.id, .2, session=session) is None
+    session.refresh(task)
+    assert task.has_waiters is True
+
+    thread = threading.Timer(.2, worker, kwargs=dict(tries=0))
+    thread.start()
+    try:
+        finished = wait(task.id, 5, session=session)
+    finally:
+        thread.join()
+
+    assert finished.status == 'success'
+    assert finished.result == {'answer': 42}
+
+    # Already finished
+    assert wait(task.id, 0, session=session).result == {'answer': 42}
+    assert wait(0, 1, session=session) is None
+
+    task = BadTask()
+    session.add(task)
+    session.commit()
+    thread = threading.Timer(.2, worker, kwargs=dict(tries=0))
+    thread.start()
+    try:
+        assert wait(task.id, 5, session=session).status == 'failed'
+    finally:
+        thread.join()
+
+
+def test_unserializable_result(db):
+    session = db()
+    session.add(DatetimeResultTask())
+    session.add(ResultTask(priority=1))
+    session.commit()
+
+    # Succeeded, but the result could not be stored
+    tasks = worker(tries=0, batch_size=10)
+    assert [status for _, status in tasks] == ['success', 'success']
+    task = session.query(DatetimeResultTask).one()
+    assert task.result is None
+
+    session.add(DatetimeResultTask())
+    session.add(ResultTask(priority=2))
+    session.commit()
+    tasks = async_worker(tries=0)
+    assert [status for _, status in tasks] == ['success', 'success']
+    assert session.query(ResultTask) \
+        .filter(ResultTask.priority == 2) \
+        .one().result == {'answer': 2}
+
+
+def test_result_waiter(db):
+    session = db()
+    waiter = _get_result_waiter(session.bind)
+    assert _get_result_waiter(session.bind) is waiter
+
+    # Reconnecting when the listening connection is lost
+    waiter.listener.connection.close()
+    task = ResultTask()
+    session.add(task)
+    session.commit()
+    thread = threading.Timer(.2, worker, kwargs=dict(tries=0))
+    thread.start()
+    try:
+        assert wait(task.id, 5, session=session).status == 'success'
+    finally:
+        thread.join()
+
+    assert waiter.is_alive()
+    assert _get_result_waiter(session.bind) is waiter
+
+    stop_result_waiter()
+    assert not waiter.is_alive()
+    assert _get_result_waiter(session.bind) is not waiter
+
+
+def test_timeout(db):
+    session = db()
+    task = HungTask()
+    session.add(task)
+    session.commit()
+
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'hung_task')
+    assert tasks == [(task.id, 'timed-out')]
+    assert watchdog.watches == {}
+    session.refresh(task)
+    assert task.status == 'timed-out'
+    assert 'TaskTimeoutError' in task.fail_reason
+    assert task.next_attempt_at is not None
+
+    # Retried when due, then failed for good
+    task.next_attempt_at = datetime.utcnow()
+    session.commit()
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'hung_task')
+    assert tasks == [(task.id, 'failed')]
+    session.refresh(task)
+    assert 'TaskTimeoutError' in task.fail_reason
+    assert task.attempts == 2
+    assert task.next_attempt_at is None
+    assert wait(task.id, 0, session=session) is not None
+
+    task = HungAsyncTask()
+    session.add(task)
+    session.commit()
+    tasks = async_worker(tries=0)
+    assert tasks == [(task.id, 'failed')]
+
+
+def test_throttle(db):
+    session = db()
+    for i in range(3):
+        session.add(ExclusiveTask(priority=100))
+        session.add(RateLimitedTask(priority=90))
+    session.add(AnotherTask())
+    session.commit()
+
+    throttle = TaskThrottle()
+
+    # Each type is capped by its own budget, the rate limited ones by the
+    # bucket.
+    tasks = throttle.pop_many(10, session=session)
+    assert [type(t) for t in tasks] == \
+        [ExclusiveTask, RateLimitedTask, RateLimitedTask, AnotherTask]
+    exclusive_task = tasks[0]
+    assert throttle.running == {'exclusive_task': 1, 'rate_limited_task': 2}
+
+    # Exclusive tasks are excluded until released
+    with pytest.raises(TaskPopError):
+        throttle.pop_many(10, session=session)
+
+    throttle.release(exclusive_task)
+    tasks = throttle.pop_many(10, session=session)
+    assert [type(t) for t in tasks] == [ExclusiveTask]
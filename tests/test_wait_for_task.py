@@ -0,0 +1,36 @@
+from bddrest import response, status
+from nanohttp import json, RestController
+
+from restfulpy.controllers import wait_for_task
+from restfulpy.orm import DBSession
+from restfulpy.taskqueue import RestfulpyTask
+from restfulpy.testing import ApplicableTestCase
+
+
+class LongTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'long_task'
+    }
+
+    def do_(self, context):
+        return 'done'
+
+
+class Root(RestController):
+
+    @json
+    def post(self):
+        task = LongTask()
+        DBSession.add(task)
+        DBSession.commit()
+        return wait_for_task(task.id, .3, '/tasks/{id}')
+
+
+class TestWaitForTask(ApplicableTestCase):
+    __controller_factory__ = Root
+
+    def test_wait_for_task(self):
+        with self.given('Nobody executes the task', verb='POST', url='/'):
+            assert status == 202
+            assert response.headers['Location'].startswith('/tasks/')